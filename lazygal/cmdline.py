@@ -43,7 +43,10 @@ from . import config
 from . import generators
 from . import config
 from . import eyecandy
+from . import genmedia
 from . import log
+from . import make
+from . import watch
 
 
 def main():
@@ -108,6 +111,15 @@ def main():
         dest="force_gen_pages",
         help=_("Force rebuild of all pages."),
     )
+    parser.add_option(
+        "",
+        "--ignore-gen-date",
+        action="store_true",
+        dest="ignore_gen_date",
+        help=_(
+            "Do not write again web pages which only differ by their generation date."
+        ),
+    )
     parser.add_option(
         "",
         "--clean-destination",
@@ -140,6 +152,85 @@ def main():
             "Exhaustively go through all directories regardless of source modification time."
         ),
     )
+    parser.add_option(
+        "",
+        "--checksum",
+        action="store_true",
+        dest="checksum",
+        help=_(
+            "Do not generate again images and videos which source contents did not change, regardless of their modification time."
+        ),
+    )
+    parser.add_option(
+        "",
+        "--metadata-cache",
+        action="store",
+        metavar=_("FILE"),
+        dest="metadata_cache",
+        help=_(
+            "Keep the metadata read from media files in the FILE database, shared by all the directories of the album."
+        ),
+    )
+    parser.add_option(
+        "",
+        "--compiled-render",
+        action="store_true",
+        dest="compiled_render",
+        help=_(
+            "Serialize web pages in a single pass which keeps the markup of tags from one page to the next."
+        ),
+    )
+    parser.add_option(
+        "",
+        "--fsync",
+        action="store_true",
+        dest="fsync",
+        help=_("Flush generated files to disk before they replace the previous ones."),
+    )
+    parser.add_option(
+        "",
+        "--profile-build",
+        action="store",
+        metavar=_("FILE"),
+        dest="profile_build",
+        help=_(
+            "Write to FILE the time and I/O spent by each kind of task, as CSV if FILE ends with .csv, else as JSON."
+        ),
+    )
+    parser.add_option(
+        "",
+        "--streaming",
+        action="store_true",
+        dest="streaming",
+        help=_(
+            "Only keep a summary of each generated directory, so that memory use depends on the depth of the source tree instead of its size."
+        ),
+    )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        action="store",
+        type="int",
+        dest="jobs",
+        help=_("Number of media and pages to build in parallel (default is 1)."),
+    )
+    parser.add_option(
+        "",
+        "--video-jobs",
+        action="store",
+        type="int",
+        dest="video_jobs",
+        help=_("Number of videos to transcode in parallel (default is 1)."),
+    )
+    parser.add_option(
+        "",
+        "--watch",
+        action="store_true",
+        dest="watch",
+        help=_(
+            "After generation, keep watching the source directory and update the web gallery when it changes."
+        ),
+    )
     parser.add_option(
         "",
         "--dir-flattening-depth",
@@ -170,6 +261,17 @@ def main():
             "Size of thumbnails, define as SIZE, eg. 150x113. See manual page for SIZE syntax."
         ),
     )
+    parser.add_option(
+        "",
+        "--thumbnail-resample",
+        action="store",
+        type="choice",
+        choices=list(genmedia.THUMBNAIL_RESAMPLES),
+        dest="thumbnail_resample",
+        help=_(
+            "Resampling of thumbnails, lanczos for best quality, or fast. Default is lanczos."
+        ),
+    )
     parser.add_option(
         "-q",
         "--quality",
@@ -204,6 +306,17 @@ def main():
             "Do not copy original photos in output directory, instead create symlinks to their original locations."
         ),
     )
+    parser.add_option(
+        "",
+        "--orig-link",
+        action="store",
+        type="choice",
+        choices=list(make.LINK_MODES),
+        dest="orig_link",
+        help=_(
+            "How original photos are copied in output directory: copy, hardlink, reflink or auto. Default is copy."
+        ),
+    )
     parser.add_option(
         "",
         "--puburl",
@@ -340,11 +453,35 @@ def main():
         cmdline_config.set("runtime", "debug", True)
     if options.check_all_dirs:
         cmdline_config.set("runtime", "check-all-dirs", True)
+    if options.checksum:
+        cmdline_config.set("runtime", "checksum", True)
+    if options.metadata_cache is not None:
+        cmdline_config.set("runtime", "metadata-cache", options.metadata_cache)
+    if options.compiled_render:
+        cmdline_config.set("runtime", "compiled-render", True)
+    if options.fsync:
+        cmdline_config.set("runtime", "fsync", True)
+    if options.profile_build is not None:
+        cmdline_config.set("runtime", "profile-build", options.profile_build)
+    if options.streaming:
+        cmdline_config.set("runtime", "streaming", True)
+    if options.jobs is not None:
+        if options.jobs < 1:
+            print(_("Option --jobs expects a positive number."))
+            sys.exit(1)
+        cmdline_config.set("runtime", "jobs", options.jobs)
+    if options.video_jobs is not None:
+        if options.video_jobs < 1:
+            print(_("Option --video-jobs expects a positive number."))
+            sys.exit(1)
+        cmdline_config.set("runtime", "video-jobs", options.video_jobs)
 
     if options.dest_dir is not None:
         cmdline_config.set("global", "output-directory", options.dest_dir)
     if options.force_gen_pages:
         cmdline_config.set("global", "force-gen-pages", True)
+    if options.ignore_gen_date:
+        cmdline_config.set("global", "ignore-gen-date", True)
     if options.clean_destination:
         cmdline_config.set("global", "clean-destination", True)
     if options.preserve is not None:
@@ -370,6 +507,8 @@ def main():
         cmdline_config.set("webgal", "image-size", options.image_size)
     if options.thumbnail_size is not None:
         cmdline_config.set("webgal", "thumbnail-size", options.thumbnail_size)
+    if options.thumbnail_resample is not None:
+        cmdline_config.set("webgal", "thumbnail-resample", options.thumbnail_resample)
     if options.thumbs_per_page is not None:
         cmdline_config.set("webgal", "thumbs-per-page", options.thumbs_per_page)
     if options.pic_sort_by is not None:
@@ -390,6 +529,8 @@ def main():
             sys.exit(1)
         else:
             cmdline_config.set("webgal", "original-symlink", True)
+    if options.orig_link is not None:
+        cmdline_config.set("webgal", "original-link", options.orig_link)
     if options.dirzip:
         cmdline_config.set("webgal", "dirzip", True)
     if options.quality is not None:
@@ -435,14 +576,21 @@ def main():
         else:
             progress = None
 
-    if options.metadata:
-        album.generate_default_metadata()
-    else:
-        try:
-            album.generate(progress=progress)
-        except KeyboardInterrupt:
-            print(_("Interrupted."), file=sys.stderr)
-            sys.exit(1)
+    with album:
+        if options.metadata:
+            album.generate_default_metadata()
+        else:
+            try:
+                album.generate(progress=progress)
+                if options.watch:
+                    watcher = watch.get_watcher(album)
+                    logging.info(_("Watching %s for changes."), album.source_dir)
+                    while True:
+                        changed_dirs = watcher.wait()
+                        album.generate(changed_dirs=changed_dirs)
+            except KeyboardInterrupt:
+                print(_("Interrupted."), file=sys.stderr)
+                sys.exit(1)
 
 
 # vim: ts=4 sw=4 expandtab
@@ -24,6 +24,7 @@ import functools
 import json
 import copy
 
+from . import make
 
 USER_CONFIG_PATH = os.path.expanduser("~/.lazygal/config")
 DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "defaults.json")
@@ -172,6 +173,14 @@ def get_int(s):
     return int(s)
 
 
+def get_choice(s, choices):
+    if s not in choices:
+        raise ValueError(
+            _("Unknown value '%s', expected one of: %s") % (s, ", ".join(choices))
+        )
+    return s
+
+
 def get_order(s):
     try:
         order, reverse = s.split(":")
@@ -205,9 +214,16 @@ STRING_TO_JSON = collections.OrderedDict(
             "quiet": get_bool,
             "debug": get_bool,
             "check-all-dirs": get_bool,
+            "jobs": get_int,
+            "video-jobs": get_int,
+            "checksum": get_bool,
+            "compiled-render": get_bool,
+            "fsync": get_bool,
+            "streaming": get_bool,
         },
         "global": {
             "force-gen-pages": get_bool,
+            "ignore-gen-date": get_bool,
             "clean-destination": get_bool,
             "preserve": get_list,
             "dir-flattening-depth": functools.partial(false_or, f=get_int),
@@ -219,12 +235,14 @@ STRING_TO_JSON = collections.OrderedDict(
         "webgal": {
             "image-size": get_image_size,
             "thumbs-per-page": get_int,
+            "video-thumbnail-frames": get_int,
             "filter-by-tag": get_list,
             "sort-medias": get_order,
             "sort-subgals": get_order,
             "original": get_bool,
             "original-baseurl": false_or,
             "original-symlink": get_bool,
+            "original-link": functools.partial(get_choice, choices=make.LINK_MODES),
             "dirzip": get_bool,
             "jpeg-quality": get_int,
             "jpeg-optimize": get_bool,
@@ -339,6 +357,16 @@ class LazygalConfig(object):
         else:
             self.files.append(path)
 
+    def copy(self):
+        """
+        Returns a copy of this configuration, without reading the defaults
+        again.
+        """
+        new_config = copy.copy(self)
+        new_config.c = copy.deepcopy(self.c)
+        new_config.files = list(self.files)
+        return new_config
+
     def __str__(self):
         return json.dumps(self.c)
 
@@ -21,6 +21,7 @@ import sys
 from xml.etree import ElementTree as ET
 
 
+from . import make
 from . import pathutils
 
 
@@ -94,7 +95,8 @@ class RSS20(object):
         pubdate.text = email.utils.formatdate(localtime=True)
 
         feedtree = ET.ElementTree(root)
-        feedtree.write(path, "utf-8")
+        with make.atomic_open(path) as feed_fp:
+            feedtree.write(feed_fp, "utf-8")
 
 
 # vim: ts=4 sw=4 expandtab
@@ -24,6 +24,7 @@ import sys
 import re
 import fnmatch
 import shutil
+import itertools
 
 from .config import LazygalConfig
 from .config import USER_CONFIG_PATH, LazygalConfigDeprecated
@@ -37,6 +38,7 @@ from . import pindex
 from . import tpl
 from . import newsize
 from . import metadata
+from . import mdcache
 from . import genpage
 from . import genmedia
 from . import genfile
@@ -73,7 +75,7 @@ class SubgalSort(make.MakeTask):
 
         order = self.webgal_dir.subgal_sort_by["order"]
         if order == "exif":
-            subgal_sortkey = lambda x: x.source_dir.latest_media_stamp()
+            subgal_sortkey = lambda x: x.pindex.latest_media_stamp()
         elif order == "mtime":
             subgal_sortkey = lambda x: x.source_dir.get_mtime()
         elif order == "numeric":
@@ -148,7 +150,7 @@ class SubgalBreak(make.MakeTask):
         galleries.append((self.webgal_dir, self.webgal_dir.medias))
         if self.webgal_dir.flatten_below():
             subgals = []
-            for dir in self.webgal_dir.get_all_subgals():
+            for dir in self.webgal_dir.iter_all_subgals():
                 dir.call_populate_deps()
                 galleries.append((dir, dir.medias))
         else:
@@ -163,7 +165,9 @@ class SubgalBreak(make.MakeTask):
 
         galleries = []
         how_many_medias = 0
-        subgals_it = iter([self.webgal_dir] + self.webgal_dir.get_all_subgals())
+        subgals_it = itertools.chain(
+            [self.webgal_dir], self.webgal_dir.iter_all_subgals()
+        )
         for subgal in subgals_it:
             how_many_medias += subgal.pindex.get_media_count()
             galleries.append((subgal, subgal.medias))
@@ -240,7 +244,9 @@ class WebalbumMediaTask(make.GroupTask):
 
     def get_original_or_symlink(self):
         if not self.webgal.orig_symlink:
-            return genfile.CopyMediaOriginal(self.webgal, self.media)
+            return genfile.CopyMediaOriginal(
+                self.webgal, self.media, self.webgal.orig_link
+            )
         else:
             return genfile.SymlinkMediaOriginal(self.webgal, self.media)
 
@@ -263,11 +269,15 @@ class WebalbumImageTask(WebalbumMediaTask):
     """
 
     def __init__(self, webgal, image):
+        # All sizes of the picture are resized from a single decoding.
+        self.resize_batch = genmedia.ImageResizeBatch(image)
+
         super().__init__(webgal, image)
 
         self.thumb = genmedia.ImageOtherSize(
             self.webgal, self.media, genmedia.THUMB_SIZE_NAME
         )
+        self.resize_batch.add(self.thumb)
         self.add_dependency(self.thumb)
 
     def get_resized(self, size_name):
@@ -279,6 +289,7 @@ class WebalbumImageTask(WebalbumMediaTask):
                 # Do not process if size is the same
                 return self.get_original()
             else:
+                self.resize_batch.add(sized)
                 return sized
 
 
@@ -297,6 +308,17 @@ class WebalbumVideoTask(WebalbumMediaTask):
         )
         self.add_dependency(self.thumb)
 
+        if self.webvideo is not None and not make.get_scheduler().in_background(
+            self.webvideo
+        ):
+            # The thumbnail and the transcoding share a single decoding,
+            # unless the transcoding runs in the background. The thumbnail
+            # frames are picked across the whole video, so a shared
+            # decoding would hold the thumbnail, and the pages and the
+            # directory waiting for it, until the transcoding is done. It
+            # then decodes the video on its own instead.
+            genmedia.VideoBatch(self.media, self.thumb, self.webvideo)
+
     def get_resized(self, size_name):
         if not self.webvideo:
             self.webvideo = genmedia.WebVideo(
@@ -311,6 +333,10 @@ class WebalbumDir(make.GroupTask):
     This is a built web gallery with its files, thumbs and reduced pics.
     """
 
+    # The whole directory is built before its build index is dumped and its
+    # destination cleaned up. Its medias are not waited for one by one.
+    join = True
+
     def __init__(self, dir, subgals, album, album_dest_dir, progress=None):
         self.source_dir = dir
         self.path = os.path.join(album_dest_dir, self.source_dir.strip_root())
@@ -318,6 +344,9 @@ class WebalbumDir(make.GroupTask):
             self.path = os.path.dirname(self.path)
 
         super().__init__()
+        # The outputs of all the tasks of the directory pile up here, and are
+        # looked up for each file of the output directory.
+        self.output_items = set()
 
         self.progress = progress
 
@@ -327,8 +356,7 @@ class WebalbumDir(make.GroupTask):
 
         self.flattening_dir = None
 
-        self.config = LazygalConfig()
-        self.config.load(self.album.config)
+        self.config = self.album.dir_config(self.source_dir.path)
         self.__configure()
 
         self.pindex = pindex.PersistentIndex(self)
@@ -336,6 +364,9 @@ class WebalbumDir(make.GroupTask):
         self.webassets = pindex.WebAssets(self)
         self.webassets.add_dependency(self.pindex)
 
+        self.build_index = pindex.BuildIndex(self)
+        self.register_output(self.build_index.path)
+
     def populate_deps(self):
         super().populate_deps()
 
@@ -346,6 +377,7 @@ class WebalbumDir(make.GroupTask):
         self.medias = []
         self.sort_task = SubgalSort(self)
         self.sort_task.add_dependency(self.source_dir)
+        self.source_dir.extract_medias_metadata(self.pindex)
         for media in self.source_dir.medias:
             media.load_metadata(self.pindex)
             if self.tagfilters:
@@ -469,18 +501,6 @@ class WebalbumDir(make.GroupTask):
         return tpl_vars
 
     def __configure(self):
-        config_dirs = self.source_dir.parent_paths()[:-1]  # strip root dir
-        config_dirs.reverse()  # from root to deepest
-        config_files = list(
-            map(lambda d: os.path.join(d, SOURCEDIR_CONFIGFILE), config_dirs)
-        )
-        logging.debug(
-            _("  Trying loading gallery configs: %s"),
-            ", ".join(map(self.source_dir.strip_root, config_files)),
-        )
-        for c in config_files:
-            self.config.load_any(c)
-
         self.browse_sizes = []
         self.newsizers = {}
         self.__parse_browse_sizes(self.config.get("webgal", "image-size"))
@@ -502,6 +522,7 @@ class WebalbumDir(make.GroupTask):
             self.config.get("webgal", "original-baseurl"),
             self.config.get("webgal", "original-symlink"),
         )
+        self.orig_link = self.config.get("webgal", "original-link")
 
         self.thumbs_per_page = self.config.get("webgal", "thumbs-per-page")
 
@@ -537,6 +558,9 @@ class WebalbumDir(make.GroupTask):
         else:
             self.orig_base = None
 
+    def get_dirzip_info(self):
+        return self.webassets.data["dirzip"]
+
     def get_webalbumpic_filename(self):
         if self.webalbumpic_bg == "transparent":
             ext = ".png"  # JPEG does not have an alpha channel
@@ -578,7 +602,7 @@ class WebalbumDir(make.GroupTask):
     def register_output(self, output):
         # We only care about output in the current directory
         if os.path.dirname(output) == self.path:
-            super().register_output(output)
+            self.output_items.add(output)
 
     def register_feed(self, feed):
         self.feed = feed
@@ -589,11 +613,17 @@ class WebalbumDir(make.GroupTask):
         else:
             return len(self.source_dir.subdirs)
 
-    def get_all_subgals(self):
-        all_subgals = list(self.subgals)  # We want a copy here.
+    def iter_all_subgals(self):
+        """
+        Yields the subgalleries, then the ones below each of them,
+        recursively.
+        """
+        yield from self.subgals
         for subgal in self.subgals:
-            all_subgals.extend(subgal.get_all_subgals())
-        return all_subgals
+            yield from subgal.iter_all_subgals()
+
+    def get_all_subgals(self):
+        return list(self.iter_all_subgals())
 
     def has_media(self):
         if self.tagfilters:
@@ -667,7 +697,13 @@ class WebalbumDir(make.GroupTask):
         extra_files = []
         if self.source_dir.is_album_root():
             extra_files.append(os.path.join(self.path, DEST_SHARED_DIRECTORY_NAME))
+        if self.path == self.source_dir.path:
+            # Source files are not outputs, but they are not foreign either.
+            extra_files.extend(
+                os.path.join(self.path, f) for f in self.source_dir.filenames
+            )
 
+        scheduler = make.get_scheduler()
         dirnames = [d.source_dir.name for d in self.subgals]
         expected_dirs = list(map(lambda dn: os.path.join(self.path, dn), dirnames))
         for dest_file in os.listdir(self.path):
@@ -676,6 +712,8 @@ class WebalbumDir(make.GroupTask):
                 dest_file not in self.output_items
                 and dest_file not in expected_dirs
                 and dest_file not in extra_files
+                # Written by a task running in the background
+                and not scheduler.is_writing(dest_file)
             ):
                 foreign_files.append(dest_file)
 
@@ -691,20 +729,89 @@ class WebalbumDir(make.GroupTask):
         if self._deps_populated or self.tagfilters:
             return self.needs_build()
 
-        return self.pindex.needs_build()
+        return (
+            self.pindex.needs_build()
+            or self.build_index.config_changed()
+            or self.build_index.lacks_digests()
+        )
 
     def build(self):
+        self.build_index.make()
+
         for dest_file in self.list_foreign_files():
             self.album.cleanup(dest_file, self.path)
 
     def make(self, force=False):
         super().make(force)
+        if self.build_index.lacks_digests():
+            # Checksum mode was enabled, medias up to date were not made.
+            for media_task in self.medias:
+                for dep in media_task.deps:
+                    if isinstance(dep, genmedia.GeneratedMedia):
+                        dep.record_up_to_date()
+        # Remember the media options, even if no media needed a build.
+        self.build_index.make()
         self.update_build_status()
 
     def media_done(self):
         if self.progress is not None:
             self.progress.media_done()
 
+    def summarize(self):
+        """
+        Returns what the gallery above and the feed need from this one once
+        it is generated, see WebalbumDirSummary.
+        """
+        return WebalbumDirSummary(self)
+
+
+class WebalbumDirSummary(object):
+    """
+    What is kept of a WebalbumDir once generated in streaming mode. This is
+    only what the gallery above it and the feed need, so that the medias,
+    tasks and pages of the gallery can be freed.
+    """
+
+    def __init__(self, webgal):
+        self.path = webgal.path
+        self.pindex = pindex.PersistentIndexSummary(webgal.pindex)
+        latest = self.pindex.latest_stamps()
+        self.source_dir = sourcetree.DirectorySummary(
+            webgal.source_dir, (latest["date"], latest["mtime"])
+        )
+
+        self.__mtime = webgal.get_mtime()
+        self.__has_media = webgal.has_media()
+        self.__has_media_below = webgal.has_media_below()
+        self.__flattened = webgal.should_be_flattened()
+        self.__subgal_count = webgal.get_subgal_count()
+        self.__dirzip_info = webgal.get_dirzip_info()
+        self.__webalbumpic_filename = webgal.get_webalbumpic_filename()
+
+    def get_mtime(self):
+        return self.__mtime
+
+    def has_media(self):
+        return self.__has_media
+
+    def has_media_below(self):
+        return self.__has_media_below
+
+    def should_be_flattened(self):
+        return self.__flattened
+
+    def get_subgal_count(self):
+        return self.__subgal_count
+
+    def get_dirzip_info(self):
+        return self.__dirzip_info
+
+    def get_webalbumpic_filename(self):
+        return self.__webalbumpic_filename
+
+    def rel_path(self, path):
+        return os.path.relpath(path, self.path)
+
 
 class SharedFiles(make.FileMakeObject):
 
@@ -752,10 +859,10 @@ class DummyProgress(object):
     def media_done(self, how_many=1):
         pass
 
-    def set_task_progress(self, percent):
+    def set_task_progress(self, percent, task=None):
         pass
 
-    def set_task_done(self):
+    def set_task_done(self, task=None):
         pass
 
     def updated(self):
@@ -771,7 +878,7 @@ class AlbumGenProgress(object):
         self._medias_total = medias_total
         self._medias_done = 0
 
-        self._task_percent = None
+        self._tasks_percent = {}
 
     def dir_done(self):
         self._dirs_done = self._dirs_done + 1
@@ -781,12 +888,12 @@ class AlbumGenProgress(object):
         self._medias_done = self._medias_done + how_many
         self.updated()
 
-    def set_task_progress(self, percent):
-        self._task_percent = percent
+    def set_task_progress(self, percent, task=None):
+        self._tasks_percent[task] = percent
         self.updated()
 
-    def set_task_done(self):
-        self._task_percent = None
+    def set_task_done(self, task=None):
+        self._tasks_percent.pop(task, None)
         self.updated()
 
     def __str__(self):
@@ -812,8 +919,14 @@ class AlbumGenProgress(object):
                 )
             )
 
-        if self._task_percent is not None:
-            msg.append(_("current task %d%%") % self._task_percent)
+        tasks_percent = list(self._tasks_percent.values())
+        if len(tasks_percent) == 1:
+            msg.append(_("current task %d%%") % tasks_percent[0])
+        elif tasks_percent:
+            msg.append(
+                _("current tasks %s")
+                % ", ".join("%d%%" % percent for percent in tasks_percent)
+            )
 
         return _("Progress: %s") % ", ".join(msg)
 
@@ -858,6 +971,7 @@ class Album(object):
             "global", "preserve_args"
         )
         self.force_gen_pages = self.config.get("global", "force-gen-pages")
+        self.ignore_gen_date = self.config.get("global", "ignore-gen-date")
 
         self.set_theme(self.config.get("global", "theme"))
         self.excludes = self.config.get("global", "exclude") + self.config.get(
@@ -868,9 +982,36 @@ class Album(object):
 
         self.__statistics = None
 
+        mdcache_path = self.config.get("runtime", "metadata-cache")
+        if mdcache_path:
+            self.mdcache = mdcache.MetadataCache(mdcache_path)
+            self.scan_journal = pathutils.ScanJournal(self.mdcache.load_scan_journal())
+        else:
+            self.mdcache = None
+            self.scan_journal = pathutils.ScanJournal()
+        self.__scan = None
+        self.__dir_configs = None
+        self.__late_build_indexes = None
+
+    def close(self):
+        """
+        Closes the metadata cache, if any. Album objects are also context
+        managers closing themselves on exit.
+        """
+        if self.mdcache is not None:
+            self.mdcache.close()
+            self.mdcache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def set_theme(self, theme_name=theme.DEFAULT_THEME):
         self.theme = theme.Theme(os.path.join(DATAPATH, "themes"), theme_name)
         self.theme.prepare_tpl_loader(tpl.TplFactory)
+        self.theme.tpl_loader.compiled = self.config.get("runtime", "compiled-render")
         self.theme.check_shared_files()
 
     def _str_humanize(self, text):
@@ -890,10 +1031,13 @@ class Album(object):
                 if fnmatch.fnmatch(tail, pattern):
                     logging.info("  PRESERVE %s", tail)
                     return
-            if os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-            else:
-                os.unlink(file_path)
+            try:
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.unlink(file_path)
+            except FileNotFoundError:
+                return  # e.g. a temporary file which was just renamed
             logging.info("  RM %s", file_path)
 
     def generate_default_metadata(self):
@@ -911,10 +1055,66 @@ class Album(object):
 
             metadata.DefaultMetadata(source_dir, self).make()
 
+    def dump_build_index_later(self, build_index):
+        """
+        Dumps build_index again once the tasks running in the background are
+        done, for the records they add after their directory is generated.
+        """
+        self.__late_build_indexes.add(build_index)
+
+    def dir_config(self, dir_path):
+        """
+        Returns the configuration of the source directory dir_path: the album
+        configuration, then the configuration files of the directories below
+        the album root down to dir_path.
+
+        It is derived from the configuration of the parent directory. During
+        a generation, the configurations of the directories above are kept
+        until those are generated, so that each configuration file is only
+        read once. The returned configuration is handed over to the caller.
+        """
+        dir_configs = self.__dir_configs
+        if dir_configs is None:
+            dir_configs = {}
+        self.__resolve_dir_config(dir_path, dir_configs)
+        return dir_configs.pop(dir_path)
+
+    def __resolve_dir_config(self, dir_path, dir_configs):
+        if dir_path not in dir_configs:
+            if dir_path == self.source_dir:
+                dir_config = LazygalConfig()
+                dir_config.load(self.config)
+            elif pathutils.is_root(dir_path):
+                raise RuntimeError(_("Root not found"))
+            else:
+                parent_path = os.path.dirname(dir_path)
+                self.__resolve_dir_config(parent_path, dir_configs)
+                dir_config = dir_configs[parent_path].copy()
+                config_file = os.path.join(dir_path, SOURCEDIR_CONFIGFILE)
+                logging.debug(
+                    _("  Trying loading gallery configs: %s"),
+                    os.path.relpath(config_file, self.source_dir),
+                )
+                dir_config.load_any(config_file)
+            dir_configs[dir_path] = dir_config
+
+    def scan(self):
+        """
+        Returns the (root, dirnames, filenames) tuples of the source tree,
+        bottom-up like pathutils.walk(). The tree is only walked once per
+        generation, and directories which did not change since the previous
+        scan are not listed again.
+        """
+        if self.__scan is None:
+            self.__scan = list(self.scan_journal.walk(self.source_dir))
+            if self.mdcache is not None:
+                self.mdcache.store_scan_journal(self.scan_journal)
+        return self.__scan
+
     def stats(self):
         if self.__statistics is None:
             self.__statistics = {"total": 0, "bydir": {}}
-            for root, dirnames, filenames in pathutils.walk(self.source_dir):
+            for root, dirnames, filenames in self.scan():
                 dir_medias = len(
                     [
                         f
@@ -926,7 +1126,12 @@ class Album(object):
                 self.__statistics["bydir"][root] = dir_medias
         return self.__statistics
 
-    def generate(self, dest_dir=None, progress=None):
+    def generate(self, dest_dir=None, progress=None, changed_dirs=None):
+        """
+        Generates the web gallery in dest_dir. If changed_dirs is not None,
+        only the directories of changed_dirs and their parents are checked
+        for changes.
+        """
         if dest_dir is None:
             dest_dir = self.config.get("global", "output-directory")
         sane_dest_dir = os.path.abspath(os.path.expanduser(dest_dir))
@@ -936,6 +1141,7 @@ class Album(object):
 
         pub_url = self.config.get("global", "puburl")
         check_all_dirs = self.config.get("runtime", "check-all-dirs")
+        streaming = self.config.get("runtime", "streaming")
 
         if self.is_in_sourcetree(sane_dest_dir):
             raise ValueError(
@@ -949,85 +1155,129 @@ class Album(object):
         else:
             feed = None
 
-        dir_heap = {}
-        for root, dirnames, filenames in pathutils.walk(self.source_dir):
+        profile_path = self.config.get("runtime", "profile-build")
+        profile = profile_path and make.BuildProfile() or None
+
+        self.__dir_configs = {}
+        self.__late_build_indexes = set()
+        with make.Scheduler(
+            self.config.get("runtime", "jobs"),
+            self.config.get("runtime", "video-jobs"),
+            self.config.get("runtime", "fsync"),
+            profile,
+        ) as scheduler:
+            dir_heap = {}
+            for root, dirnames, filenames in self.scan():
+
+                if root in dir_heap:
+                    subdirs, subgals = dir_heap[root]
+                    del dir_heap[root]  # No need to keep it there
+                else:
+                    subdirs = []
+                    subgals = []
 
-            if root in dir_heap:
-                subdirs, subgals = dir_heap[root]
-                del dir_heap[root]  # No need to keep it there
-            else:
-                subdirs = []
-                subgals = []
+                checked_dir = sourcetree.File(root, self)
 
-            checked_dir = sourcetree.File(root, self)
+                if checked_dir.should_be_skipped():
+                    logging.debug(_("(%s) has been skipped"), checked_dir.path)
+                    continue
+                if checked_dir.path == os.path.join(
+                    sane_dest_dir, DEST_SHARED_DIRECTORY_NAME
+                ):
+                    logging.error(
+                        _(
+                            "(%s) has been skipped because its name collides with the shared material directory name"
+                        ),
+                        checked_dir.path,
+                    )
+                    continue
 
-            if checked_dir.should_be_skipped():
-                logging.debug(_("(%s) has been skipped"), checked_dir.path)
-                continue
-            if checked_dir.path == os.path.join(
-                sane_dest_dir, DEST_SHARED_DIRECTORY_NAME
-            ):
-                logging.error(
-                    _(
-                        "(%s) has been skipped because its name collides with the shared material directory name"
-                    ),
-                    checked_dir.path,
-                )
-                continue
+                logging.info(_("[Entering %%ALBUMROOT%%/%s]"), checked_dir.strip_root())
+                logging.debug("(%s)", checked_dir.path)
 
-            logging.info(_("[Entering %%ALBUMROOT%%/%s]"), checked_dir.strip_root())
-            logging.debug("(%s)", checked_dir.path)
+                source_dir = sourcetree.Directory(root, subdirs, filenames, self)
 
-            source_dir = sourcetree.Directory(root, subdirs, filenames, self)
+                destgal = WebalbumDir(
+                    source_dir, subgals, self, sane_dest_dir, progress
+                )
 
-            destgal = WebalbumDir(source_dir, subgals, self, sane_dest_dir, progress)
+                if source_dir.is_album_root():
+                    # Use root config tpl vars for shared files
+                    tpl_vars = destgal.tpl_vars
+
+                if feed and source_dir.is_album_root():
+                    feed.set_title(source_dir.human_name)
+                    md = destgal.source_dir.metadata.get()
+                    if "album_description" in md.keys():
+                        feed.set_description(md["album_description"])
+                    destgal.register_output(feed.path)
+
+                if feed:
+                    destgal.register_feed(feed)
+
+                if changed_dirs is not None and not any(
+                    pathutils.is_subdir_of(root, d) for d in changed_dirs
+                ):
+                    progress.media_done(self.stats()["bydir"][destgal.source_dir.path])
+                    logging.debug("  SKIPPED because not changed")
+                elif check_all_dirs or destgal.needs_build_quick():
+                    destgal.make()
+                else:
+                    progress.media_done(self.stats()["bydir"][destgal.source_dir.path])
+                    logging.info(
+                        _(
+                            "  SKIPPED because of mtime, touch source or use --check-all-dirs to override."
+                        )
+                    )
 
-            if source_dir.is_album_root():
-                # Use root config tpl vars for shared files
-                tpl_vars = destgal.tpl_vars
+                if (
+                    streaming
+                    and not source_dir.is_album_root()
+                    and not destgal.should_be_flattened()
+                ):
+                    # Only keep what the gallery above and the feed need.
+                    destgal = destgal.summarize()
 
-            if not source_dir.is_album_root():
-                container_dirname = os.path.dirname(root)
-                if container_dirname not in dir_heap:
-                    dir_heap[container_dirname] = ([], [])
-                container_subdirs, container_subgals = dir_heap[container_dirname]
-                container_subdirs.append(source_dir)
-                container_subgals.append(destgal)
+                if feed:
+                    feed.push_dir(destgal)
 
-            if feed and source_dir.is_album_root():
-                feed.set_title(source_dir.human_name)
-                md = destgal.source_dir.metadata.get()
-                if "album_description" in md.keys():
-                    feed.set_description(md["album_description"])
-                destgal.register_output(feed.path)
+                if not source_dir.is_album_root():
+                    container_dirname = os.path.dirname(root)
+                    if container_dirname not in dir_heap:
+                        dir_heap[container_dirname] = ([], [])
+                    container_subdirs, container_subgals = dir_heap[container_dirname]
+                    container_subdirs.append(destgal.source_dir)
+                    container_subgals.append(destgal)
 
-            if feed:
-                feed.push_dir(destgal)
-                destgal.register_feed(feed)
+                if not streaming:
+                    # Force some memory cleanups, this is usefull for big albums.
+                    del destgal
+                    gc.collect()
 
-            if check_all_dirs or destgal.needs_build_quick():
-                destgal.make()
-            else:
-                progress.media_done(self.stats()["bydir"][destgal.source_dir.path])
-                logging.info(
-                    _(
-                        "  SKIPPED because of mtime, touch source or use --check-all-dirs to override."
-                    )
-                )
+                progress.dir_done()
 
-            # Force some memory cleanups, this is usefull for big albums.
-            del destgal
-            gc.collect()
+                logging.info(_("[Leaving  %%ALBUMROOT%%/%s]"), source_dir.strip_root())
 
-            progress.dir_done()
+            if feed:
+                feed.make()
 
-            logging.info(_("[Leaving  %%ALBUMROOT%%/%s]"), source_dir.strip_root())
+            # Force to check for unexpected files
+            SharedFiles(self, sane_dest_dir, tpl_vars).make(True)
 
-        if feed:
-            feed.make()
+            scheduler.wait_all()
+            for build_index in self.__late_build_indexes:
+                build_index.make()
 
-        # Force to check for unexpected files
-        SharedFiles(self, sane_dest_dir, tpl_vars).make(True)
+        if profile is not None:
+            profile.dump(profile_path)
+
+        # Next generation shall see source tree, configuration and template
+        # changes.
+        self.__scan = None
+        self.__dir_configs = None
+        self.__late_build_indexes = None
+        self.__statistics = None
+        self.theme.tpl_loader.clear()
 
 
 # vim: ts=4 sw=4 expandtab
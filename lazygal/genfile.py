@@ -19,6 +19,7 @@
 import os
 import locale
 import logging
+import shutil
 import zipfile
 
 from . import make
@@ -66,9 +67,9 @@ class MediaOriginal(WebalbumFile):
 
 class CopyMediaOriginal(MediaOriginal):
 
-    def __init__(self, dir, source_media):
+    def __init__(self, dir, source_media, link="copy"):
         super().__init__(dir, source_media)
-        self.add_dependency(make.FileCopy(self.source_media.path, self.path))
+        self.add_dependency(make.FileCopy(self.source_media.path, self.path, link))
 
     def build(self):
         logging.info("  CP %s", self.filename)
@@ -87,6 +88,17 @@ class SymlinkMediaOriginal(MediaOriginal):
 
 
 class WebalbumArchive(WebalbumFile):
+    """
+    Archive of the pictures of a directory. Pictures are already compressed
+    so they are stored as is. When pictures were only added, they are
+    appended to a copy of the existing archive instead of rewriting it,
+    which is cheap on filesystems sharing the data blocks of copies.
+    Otherwise, only the pictures which changed are read again, the others
+    are copied from the existing archive.
+    """
+
+    # Zipping is mostly I/O, let other tasks run meanwhile.
+    parallel = True
 
     def __init__(self, webgal_dir):
         self.filename = webgal_dir.source_dir.name + ".zip"
@@ -108,11 +120,91 @@ class WebalbumArchive(WebalbumFile):
         logging.info(_("  ZIP %s"), zip_rel_path)
         logging.debug("(%s)", self.path)
 
-        with zipfile.ZipFile(self.path, "w") as archive:
-            for pic in self.pics:
-                inzip_fn = os.path.join(self.dir.source_dir.name, os.path.basename(pic))
+        members = [
+            (pic, os.path.join(self.dir.source_dir.name, os.path.basename(pic)))
+            for pic in self.pics
+        ]
+        archived = self.archived_members()
+        unchanged = self.unchanged_members(archived, members)
+        changed = [(pic, fn) for pic, fn in members if fn not in unchanged]
+
+        # Keep the previous archive until the new one is complete.
+        with self.output_path() as tmp_path:
+            if archived and len(unchanged) == len(archived):
+                logging.debug("(appending %d pictures)", len(changed))
+                pathutils.copy_file(self.path, tmp_path)
+                self.write(tmp_path, "a", changed)
+            elif unchanged:
+                logging.debug(
+                    "(writing %d pictures, copying %d)", len(changed), len(unchanged)
+                )
+                self.rewrite(tmp_path, members, unchanged)
+            else:
+                self.write(tmp_path, "w", members)
+
+    def archived_members(self):
+        """
+        Returns the members of the existing archive, indexed by name.
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with zipfile.ZipFile(self.path) as archive:
+                return {info.filename: info for info in archive.infolist()}
+        except (OSError, zipfile.BadZipFile):
+            return {}
+
+    def unchanged_members(self, archived, members):
+        """
+        Returns the archived members which picture did not change, indexed
+        by their name in members.
+        """
+        unchanged = {}
+        for pic, inzip_fn in members:
+            info = zipfile.ZipInfo.from_file(pic, inzip_fn)
+            archived_info = archived.get(info.filename)
+            if (
+                archived_info is not None
+                and archived_info.compress_type == zipfile.ZIP_STORED
+                and self.dos_time(archived_info) == self.dos_time(info)
+                and archived_info.file_size == info.file_size
+            ):
+                unchanged[inzip_fn] = archived_info
+        return unchanged
+
+    @staticmethod
+    def dos_time(info):
+        # Seconds are stored with a two seconds resolution in archives.
+        year, month, day, hour, minute, second = info.date_time
+        return (year, month, day, hour, minute, second // 2)
+
+    def write(self, path, mode, members):
+        with zipfile.ZipFile(path, mode, zipfile.ZIP_STORED) as archive:
+            for pic, inzip_fn in members:
                 archive.write(pic, inzip_fn)
 
+    def rewrite(self, path, members, unchanged):
+        """
+        Writes a new archive to path, copying the unchanged members from
+        the existing archive. Those are stored, so they are copied without
+        being compressed again.
+        """
+        with zipfile.ZipFile(self.path) as previous, zipfile.ZipFile(
+            path, "w", zipfile.ZIP_STORED
+        ) as archive:
+            for pic, inzip_fn in members:
+                previous_info = unchanged.get(inzip_fn)
+                if previous_info is None:
+                    archive.write(pic, inzip_fn)
+                    continue
+                info = zipfile.ZipInfo(previous_info.filename, previous_info.date_time)
+                info.external_attr = previous_info.external_attr
+                info.file_size = previous_info.file_size
+                with previous.open(previous_info) as src_fp, archive.open(
+                    info, "w"
+                ) as dst_fp:
+                    shutil.copyfileobj(src_fp, dst_fp, 1024 * 1024)
+
     def size(self):
         return os.path.getsize(self.path)
 
@@ -18,6 +18,7 @@
 
 import os
 import logging
+import threading
 
 from PIL import Image as PILImage
 
@@ -30,14 +31,328 @@ from . import make
 from . import genfile
 from . import eyecandy
 from . import mediautils
+from . import pathutils
+from . import sourcetree
 from .metadata import GExiv2
 
 
 THUMB_SIZE_NAME = "thumb"
+# Resampling of thumbnails, from best quality to fastest
+THUMBNAIL_RESAMPLES = ("lanczos", "fast")
 VIDEO_SIZE_NAME = "video"
 
 
-class ResizedMedia(genfile.WebalbumFile):
+class ResizeJob(object):
+    """
+    The image processing part of ImageOtherSize builds for one source
+    picture. The source is decoded once, then downscaled in cascade to all
+    the requested sizes, largest first. This only holds picklable values so
+    that it can be run in a worker process.
+
+    Outputs are written through temporary files, flushed to disk before
+    replacing the previous ones if fsync is True.
+    """
+
+    TRANSPOSE_METHODS = {
+        90: PILImage.ROTATE_90,
+        180: PILImage.ROTATE_180,
+        270: PILImage.ROTATE_270,
+    }
+
+    def __init__(self, source_path, rotation, quality, options, fsync=False):
+        self.source_path = source_path
+        self.rotation = rotation
+        self.quality = quality
+        self.save_options = options
+        self.fsync = fsync
+        self.outputs = []
+
+    def add_output(self, path, unrotated_size, format, resample="lanczos"):
+        self.outputs.append((path, unrotated_size, format, resample))
+
+    def get_image(self):
+        # Let the decoder scale down (JPEG DCT scaling) to the smallest size
+        # that is still larger than all the outputs.
+        draft_size = (
+            max([size[0] for path, size, format, resample in self.outputs]),
+            max([size[1] for path, size, format, resample in self.outputs]),
+        )
+        with open(self.source_path, "rb") as im_fp:
+            im = PILImage.open(im_fp)
+            im.draft(None, draft_size)
+            im.load()
+            return im
+
+    def resize(self, im):
+        resized = []
+        previous = im
+        for path, size, format, resample in sorted(
+            self.outputs, key=lambda o: o[1][0] * o[1][1], reverse=True
+        ):
+            if previous.size[0] < size[0] or previous.size[1] < size[1]:
+                # Cascading would upscale, start over from the source.
+                previous = im
+            if resample == "fast":
+                # Box reduce by an integer factor down to twice the target
+                # size, and use a cheap filter for the remaining step.
+                previous = previous.resize(size, PILImage.BILINEAR, reducing_gap=2.0)
+            else:
+                previous = previous.resize(size, PILImage.LANCZOS)
+            resized.append((path, format, previous))
+        return resized
+
+    def rotate(self, im):
+        # Use EXIF data to rotate target image if available and required
+        if self.rotation != 0:
+            im = im.transpose(self.TRANSPOSE_METHODS[self.rotation])
+        return im
+
+    def save(self, im, path, format):
+        if format == "png":
+            self.save_png(im, path)
+        else:
+            self.save_jpeg(im, path)
+
+    def save_png(self, im, path):
+        with make.atomic_open(path, "w+b", self.fsync) as im_fp:
+            im.save(im_fp, "png", quality=self.quality, **self.save_options)
+
+    def save_jpeg(self, im, path):
+        with make.atomic_open(path, "w+b", self.fsync) as im_fp:
+            calibrated = False
+            while not calibrated:
+                try:
+                    if im.mode != "RGB":
+                        # convert indexed images into RGB mode, usefull
+                        # for PNG indexed images
+                        im = im.convert("RGB")
+                    im.save(im_fp, "jpeg", quality=self.quality, **self.save_options)
+                except IOError as e:
+                    if str(e).startswith("encoder error"):
+                        PILImageFile.MAXBLOCK = 2 * PILImageFile.MAXBLOCK
+                        im_fp.seek(0)
+                        im_fp.truncate()
+                        continue
+                    else:
+                        raise
+                calibrated = True
+
+    def run(self):
+        """
+        Returns the sizes of the written outputs indexed by path, or None if
+        the source image could not be decoded.
+        """
+        try:
+            resized = self.resize(self.get_image())
+        except OSError:
+            return None
+
+        sizes = {}
+        for path, format, im in resized:
+            im = self.rotate(im)
+            self.save(im, path, format)
+            sizes[path] = im.size
+        return sizes
+
+
+class ImageResizeBatch(make.MakeTask):
+    """
+    Resizes in one go all the sizes of a picture that need to be built, so
+    that the source picture is decoded only once.
+
+    The sizes to build are found when the batch is scheduled, in the calling
+    thread. The results are then handed to the sizes, which are built in
+    worker threads.
+    """
+
+    parallel = True
+
+    def __init__(self, source_image):
+        super().__init__()
+        self.set_dep_only()
+        self.source_image = source_image
+        self.add_dependency(self.source_image)
+
+        self.sizes = []
+        self.to_build = []
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def add(self, other_size):
+        self.sizes.append(other_size)
+        other_size.batch = self
+        other_size.add_dependency(self)
+
+    def needs_build(self):
+        with self.lock:
+            done = set(self.results.keys())
+        self.to_build = [s for s in self.sizes if s not in done and s.needs_build()]
+        return len(self.to_build) > 0
+
+    def has_result(self, other_size):
+        with self.lock:
+            return other_size in self.results
+
+    def pop_result(self, other_size):
+        with self.lock:
+            return self.results.pop(other_size)
+
+    def build(self):
+        to_build = self.to_build
+        if self.source_image.broken or not to_build:
+            return
+
+        job = ResizeJob(
+            self.source_image.path,
+            to_build[0].get_rotation(),
+            to_build[0].webgal.quality,
+            to_build[0].webgal.save_options,
+            make.get_scheduler().fsync,
+        )
+        for other_size in to_build:
+            other_size.add_to_resize_job(job)
+
+        sizes = make.get_scheduler().call(job.run)
+        with self.lock:
+            for other_size in to_build:
+                if sizes is None:
+                    self.results[other_size] = None
+                else:
+                    self.results[other_size] = sizes[other_size.path]
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            self.source_image.path.encode("utf-8"),
+        )
+
+
+class VideoBatch(make.MakeTask):
+    """
+    Extracts the thumbnail of a video and transcodes it with a single
+    decoding of the source, when both need to be built and the transcoding
+    is not run in the background.
+    """
+
+    parallel = True
+    queue = "video"
+
+    def __init__(self, source_video, thumb, webvideo):
+        super().__init__()
+        self.set_dep_only()
+        self.source_video = source_video
+        self.add_dependency(self.source_video)
+
+        self.thumb = thumb
+        self.webvideo = webvideo
+        for output in (self.thumb, self.webvideo):
+            output.batch = self
+            output.add_dependency(self)
+
+        self.results = set()
+
+    def needs_build(self):
+        return (
+            not self.results
+            and self.thumb.needs_build()
+            and self.webvideo.needs_build()
+        )
+
+    def has_result(self, output):
+        return output in self.results
+
+    def pop_result(self, output):
+        self.results.remove(output)
+
+    def build(self):
+        if self.source_video.broken:
+            return
+
+        logging.debug("(%s thumbnail along with transcoding)", self.source_video.path)
+        try:
+            with self.thumb.output_path() as thumb_path:
+                try:
+                    with self.webvideo.output_path() as webvideo_path:
+                        self.thumb.get_thumbnailer().convert(
+                            thumb_path,
+                            self.thumb.get_size(),
+                            self.webvideo.get_transcoder(),
+                            webvideo_path,
+                        )
+                except mediautils.VideoTranscodeError as e:
+                    logging.debug(str(e))
+                    self.results.add(self.thumb)
+                else:
+                    self.results.update((self.thumb, self.webvideo))
+        except mediautils.VideoError as e:
+            # Leave both for building on their own, with errors reported
+            logging.debug(str(e))
+        finally:
+            self.webvideo.progress.set_task_done(self.source_video.path)
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            self.source_video.path.encode("utf-8"),
+        )
+
+
+class GeneratedMedia(genfile.WebalbumFile):
+    """
+    A file generated from a source media. It is built again if its
+    generation parameters changed since the last build. In checksum mode, it
+    is not built again if neither the source contents nor the generation
+    parameters changed since the last build, whatever the mtimes say.
+    """
+
+    parallel = True
+
+    def get_recipe(self):
+        """
+        Returns the generation parameters, as JSON serializable values.
+        """
+        return {}
+
+    def needs_build(self):
+        build_index = self.webgal.build_index
+        if super().needs_build():
+            if build_index.is_up_to_date(self):
+                logging.debug(
+                    "%s build not needed: same source digest and recipe", self
+                )
+                return False
+            return True
+
+        if build_index.recipe_changed(self):
+            logging.debug("%s build needed: recipe changed", self)
+            return True
+        return False
+
+    def make(self, force=False):
+        super().make(force)
+        self.record_up_to_date()
+
+    def record_up_to_date(self):
+        """
+        Records the output if it is up to date but not fully recorded, e.g.
+        built before checksum mode was enabled. The configuration and the
+        source are assumed not to have changed since it was built.
+        """
+        build_index = self.webgal.build_index
+        if (
+            not make.get_scheduler().is_scheduled(self)
+            and build_index.needs_record(self)
+            and os.path.isfile(self.path)
+        ):
+            build_index.record(self)
+
+    def call_build(self):
+        super().call_build()
+        if os.path.isfile(self.path):
+            self.webgal.build_index.record(self)
+
+
+class ResizedMedia(GeneratedMedia):
 
     force_extension = None
 
@@ -55,6 +370,9 @@ class ResizedMedia(genfile.WebalbumFile):
 
         self.add_dependency(self.source_media)
 
+    def get_recipe(self):
+        return {"size": self.newsizer.resize_string}
+
     def get_size(self):
         if self.size is None:
             self.size = self.newsizer.dest_size(self.source_media.get_size())
@@ -79,61 +397,24 @@ class ImageOtherSize(ResizedMedia):
     def __init__(self, webgal, source_image, size_name):
         if "alphachannel" in source_image.md and source_image.md["alphachannel"]:
             self.force_extension = ".png"
+            self.format = "png"
         else:
             self.force_extension = ".jpg"
+            self.format = "jpeg"
         super().__init__(webgal, source_image, size_name)
 
+        if size_name == THUMB_SIZE_NAME:
+            self.resample = self.webgal.config.get("webgal", "thumbnail-resample")
+        else:
+            self.resample = "lanczos"
         self.rotation = None
+        self.batch = None
 
     def get_verb(self):
         return _("RESIZE")
 
     VERB = property(get_verb)
 
-    def resize(self, im):
-        new_size = self.get_size()
-
-        im.draft(None, new_size)
-        return im.resize(new_size, PILImage.LANCZOS)
-
-    def save(self, im):
-        if (
-            "alphachannel" in self.source_media.md
-            and self.source_media.md["alphachannel"]
-        ):
-            self.save_png(im)
-        else:
-            self.save_jpeg(im)
-
-    def save_png(self, im):
-        with open(self.path, "w+b") as im_fp:
-            im.save(
-                im_fp, "png", quality=self.webgal.quality, **self.webgal.save_options
-            )
-
-    def save_jpeg(self, im):
-        calibrated = False
-        while not calibrated:
-            with open(self.path, "w+b") as im_fp:
-                try:
-                    if im.mode != "RGB":
-                        # convert indexed images into RGB mode, usefull
-                        # for PNG indexed images
-                        im = im.convert("RGB")
-                    im.save(
-                        im_fp,
-                        "jpeg",
-                        quality=self.webgal.quality,
-                        **self.webgal.save_options
-                    )
-                except IOError as e:
-                    if str(e).startswith("encoder error"):
-                        PILImageFile.MAXBLOCK = 2 * PILImageFile.MAXBLOCK
-                        continue
-                    else:
-                        raise
-            calibrated = True
-
     def get_rotation(self):
         if self.rotation is None:
             if "rotation" in self.source_media.md["metadata"]:
@@ -169,31 +450,6 @@ class ImageOtherSize(ResizedMedia):
                 self.unrotated_size = self.size
         return self.size
 
-    def get_image(self):
-        with open(self.source_media.path, "rb") as im_fp:
-            im = PILImage.open(im_fp)
-            im.load()
-            return im
-
-    TRANSPOSE_METHODS = {
-        90: PILImage.ROTATE_90,
-        180: PILImage.ROTATE_180,
-        270: PILImage.ROTATE_270,
-    }
-
-    def resize(self, im):
-        rotation = self.get_rotation()
-        self.get_size()
-
-        im.draft(None, self.unrotated_size)
-        im = im.resize(self.unrotated_size, PILImage.LANCZOS)
-
-        # Use EXIF data to rotate target image if available and required
-        if rotation != 0:
-            im = im.transpose(self.TRANSPOSE_METHODS[rotation])
-
-        return im
-
     PRIVATE_IMAGE_TAGS = (
         "Exif.GPSInfo.GPSLongitude",
         "Exif.GPSInfo.GPSLatitude",
@@ -202,8 +458,15 @@ class ImageOtherSize(ResizedMedia):
     )
 
     def copy_metadata(self):
+        # The metadata is written to a copy, so that the resized picture is
+        # never seen partially written.
+        with self.output_path() as tmp_path:
+            pathutils.copy_file(self.path, tmp_path)
+            self.copy_metadata_to(tmp_path)
+
+    def copy_metadata_to(self, path):
         imgtags = GExiv2.Metadata(self.source_media.path)
-        dest_imgtags = GExiv2.Metadata(self.path)
+        dest_imgtags = GExiv2.Metadata(path)
         for tag in imgtags.get_exif_tags():
             try:
                 dest_imgtags[tag] = imgtags[tag]
@@ -233,16 +496,49 @@ class ImageOtherSize(ResizedMedia):
         except Exception as e:
             logging.error(_("Could not copy metadata in reduced picture: %s"), e)
 
+    def get_recipe(self):
+        recipe = super().get_recipe()
+        recipe.update(
+            {
+                "format": self.format,
+                "quality": self.webgal.quality,
+                "options": self.webgal.save_options,
+                "metadata": self.webgal.config.get("webgal", "publish-metadata"),
+                "keep-gps": self.webgal.keep_gps,
+                "resample": self.resample,
+            }
+        )
+        return recipe
+
+    def add_to_resize_job(self, job):
+        self.get_size()
+        job.add_output(self.path, self.unrotated_size, self.format, self.resample)
+
+    def get_resize_job(self):
+        job = ResizeJob(
+            self.source_media.path,
+            self.get_rotation(),
+            self.webgal.quality,
+            self.webgal.save_options,
+            make.get_scheduler().fsync,
+        )
+        self.add_to_resize_job(job)
+        return job
+
     def do_build(self):
-        try:
-            im = self.resize(self.get_image())
-        except OSError:
+        if self.batch is not None and self.batch.has_result(self):
+            size = self.batch.pop_result(self)
+        else:
+            sizes = make.get_scheduler().call(self.get_resize_job().run)
+            size = sizes and sizes[self.path]
+
+        if size is None:
             self.source_media.set_broken()
             # Make the system believe the file was built a long time ago.
             self.stamp_build(0)
             self.clean_output()
         else:
-            self.save(im)
+            logging.debug("(%s is %dx%d)", self.path, size[0], size[1])
             if self.webgal.config.get("webgal", "publish-metadata"):
                 self.copy_metadata()
 
@@ -256,11 +552,35 @@ class VideoThumb(ResizedMedia):
 
     VERB = property(get_verb)
 
+    def __init__(self, webgal, source_media, size_name):
+        super().__init__(webgal, source_media, size_name)
+        self.batch = None
+
+    def get_recipe(self):
+        recipe = super().get_recipe()
+        recipe.update(
+            {
+                "frames": self.webgal.config.get("webgal", "video-thumbnail-frames"),
+                "metric": self.webgal.config.get("webgal", "video-thumbnail-metric"),
+            }
+        )
+        return recipe
+
+    def get_thumbnailer(self):
+        return mediautils.VideoThumbnailer(
+            self.source_media.path,
+            self.webgal.config.get("webgal", "video-thumbnail-frames"),
+            self.webgal.config.get("webgal", "video-thumbnail-metric"),
+        )
+
     def do_build(self):
+        if self.batch is not None and self.batch.has_result(self):
+            self.batch.pop_result(self)
+            return
+
         try:
-            mediautils.VideoThumbnailer(self.source_media.path).convert(
-                self.path, self.get_size()
-            )
+            with self.output_path() as tmp_path:
+                self.get_thumbnailer().convert(tmp_path, self.get_size())
         except mediautils.VideoError as e:
             logging.error(
                 _("  creating %s thumbnail failed, skipped"), self.source_media.filename
@@ -280,7 +600,7 @@ class WebalbumPicture(make.FileMakeObject):
         self.add_dependency(webgal_dir.source_dir)
 
         medias = [
-            m for m in webgal_dir.source_dir.get_all_medias() if m.type == "image"
+            m for m in webgal_dir.source_dir.iter_all_medias() if m.type == "image"
         ]
 
         # Add video thumbs
@@ -290,6 +610,11 @@ class WebalbumPicture(make.FileMakeObject):
 
         for m in medias:
             self.add_dependency(m)
+        for subdir in webgal_dir.source_dir.iter_all_subdirs():
+            if isinstance(subdir, sourcetree.DirectorySummary):
+                # Only a sample of its medias is kept, but it carries the
+                # latest mtime of all of them.
+                self.add_dependency(subdir)
 
         if webgal_dir.source_dir.album_picture:
             albumpic_path = os.path.join(
@@ -324,17 +649,24 @@ class WebalbumPicture(make.FileMakeObject):
         logging.info(_("  DIRPIC %s"), os.path.basename(self.path))
         logging.debug("(%s)", self.path)
         try:
-            self.dirpic.write(self.path)
+            with self.output_path() as tmp_path:
+                self.dirpic.write(tmp_path)
         except ValueError as ex:
             logging.error(str(ex))
 
 
-class WebVideo(genfile.WebalbumFile):
+class WebVideo(GeneratedMedia):
+
+    # Transcodings run on their own pool, and the video page only links to
+    # the transcoded file, so the generation carries on meanwhile.
+    queue = "video"
+    background = True
 
     def __init__(self, webgal, source_video, size_name, progress):
         self.progress = progress
         self.webgal = webgal
         self.source_video = source_video
+        self.source_media = source_video
         self.filename = self.webgal._add_size_qualifier(
             self.source_video.filename, size_name, ".webm"
         )
@@ -343,24 +675,45 @@ class WebVideo(genfile.WebalbumFile):
 
         newsizer = self.webgal.newsizers[size_name]
         if newsizer == "original":
+            self.size_spec = newsizer
             self.new_width, self.new_height = (None, None)
         else:
+            self.size_spec = newsizer.resize_string
             self.new_width, self.new_height = newsizer.dest_size(
                 self.source_video.get_size()
             )
 
         self.add_dependency(self.source_video)
+        self.batch = None
+
+    def make(self, force=False):
+        super().make(force)
+        scheduler = make.get_scheduler()
+        if scheduler.in_background(self) and scheduler.is_scheduled(self):
+            # Only recorded once transcoded, maybe after the directory is done.
+            self.webgal.album.dump_build_index_later(self.webgal.build_index)
+
+    def get_recipe(self):
+        return {"size": self.size_spec}
+
+    def get_transcoder(self):
+        transcoder = mediautils.WebMTranscoder(self.source_video.path)
+        if self.new_width is not None and self.new_height is not None:
+            transcoder.scale((self.new_width, self.new_height))
+        transcoder.set_progress(self.progress)
+        return transcoder
 
     def build(self):
         vid_rel_path = self.rel_path(self.webgal.flattening_dir)
         logging.info(_("  TRANSCODE %s"), vid_rel_path)
 
+        if self.batch is not None and self.batch.has_result(self):
+            self.batch.pop_result(self)
+            return
+
         try:
-            transcoder = mediautils.WebMTranscoder(self.source_video.path)
-            if self.new_width is not None and self.new_height is not None:
-                transcoder.scale((self.new_width, self.new_height))
-            transcoder.set_progress(self.progress)
-            transcoder.convert(self.path)
+            with self.output_path() as tmp_path:
+                self.get_transcoder().convert(tmp_path)
         except mediautils.VideoError as e:
             logging.error(
                 _("  transcoding %s failed, skipped"), self.source_video.filename
@@ -369,7 +722,7 @@ class WebVideo(genfile.WebalbumFile):
             self.source_video.set_broken()
             self.clean_output()
         finally:
-            self.progress.set_task_done()
+            self.progress.set_task_done(self.source_video.path)
 
 
 # vim: ts=4 sw=4 expandtab
@@ -19,6 +19,7 @@
 import os
 import posixpath
 import sys
+import time
 import logging
 
 import genshi
@@ -26,6 +27,7 @@ import genshi
 from . import make
 from . import pathutils
 from . import genfile
+from . import pindex
 from . import feeds
 from . import tplvars
 
@@ -36,8 +38,8 @@ class WebalbumPage(genfile.WebalbumFile):
         self.dir = dir
         self.size_name = size_name
 
-        page_filename = self._add_size_qualifier(base_name + ".html", self.size_name)
-        super().__init__(os.path.join(dir.path, page_filename), dir)
+        self.filename = self._add_size_qualifier(base_name + ".html", self.size_name)
+        super().__init__(os.path.join(dir.path, self.filename), dir)
 
         self.page_template = None
 
@@ -46,11 +48,58 @@ class WebalbumPage(genfile.WebalbumFile):
 
     def load_tpl(self, tpl_ident):
         tpl = self.dir.album.theme.tpl_loader.load(tpl_ident)
-        self.add_file_dependency(tpl.path)
-        for subtpl in tpl.subtemplates():
-            self.add_file_dependency(subtpl.path)
+        for dependency in tpl.dependencies():
+            # Templates may include the same subtemplates.
+            if dependency not in self.deps:
+                self.add_dependency(dependency)
         return tpl
 
+    def get_check_mtime(self):
+        check_time = self.dir.build_index.page_check_time(self)
+        if check_time is not None and check_time > self.get_mtime():
+            return check_time
+        return super().get_check_mtime()
+
+    def dump(self, values):
+        """
+        Renders the page, and only writes it if its contents differ from the
+        existing page file.
+        """
+        build_index = self.dir.build_index
+        check_time = time.time()
+        previous = build_index.page_record(self)
+
+        page = None
+        if (
+            previous is not None
+            and "gen_date" in previous
+            and self.dir.album.ignore_gen_date
+        ):
+            # Render the page like it was at its previous generation date.
+            generated = previous["gen_datetime"], previous["gen_date"]
+            page = self.page_template.render(dict(values), generated)
+            if pindex.content_digest(page) != previous["digest"]:
+                page = None
+        if page is None:
+            page = self.page_template.render(values)
+            generated = values["gen_datetime"], values["gen_date"]
+        digest = pindex.content_digest(page)
+
+        if previous is not None and previous["digest"] == digest:
+            logging.debug("(%s unchanged)", self._path)
+            if "gen_date" in previous:
+                generated = previous["gen_datetime"], previous["gen_date"]
+        else:
+            with self.open_output() as page_fp:
+                page_fp.write(page)
+
+        build_index.record_page(self, digest, generated, check_time)
+
+    def call_build(self):
+        super().call_build()
+        # The page file may not have been written.
+        self.update_build_status()
+
     def init_tpl_values(self):
         tpl_values = {}
         tpl_values.update(self.dir.tpl_vars)
@@ -85,6 +134,8 @@ class WebalbumPage(genfile.WebalbumFile):
 
 class WebalbumBrowsePage(WebalbumPage):
 
+    parallel = True
+
     def __init__(self, dir, size_name, webalbum_media):
         self.webalbum_media = webalbum_media
         self.media = self.webalbum_media.media
@@ -157,7 +208,7 @@ class WebalbumBrowsePage(WebalbumPage):
 
         self.add_extra_vals(tpl_values)
 
-        self.page_template.dump(tpl_values, self._path)
+        self.dump(tpl_values)
 
 
 class WebalbumIndexPage(WebalbumPage):
@@ -295,7 +346,7 @@ class WebalbumIndexPage(WebalbumPage):
         else:
             values["feed_url"] = None
 
-        self.page_template.dump(values, self._path)
+        self.dump(values)
 
 
 class WebalbumFeed(make.FileMakeObject):
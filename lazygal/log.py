@@ -41,8 +41,13 @@ class ProgressConsoleHandler(logging.StreamHandler):
             self.handleError(record)
 
     def update_progress(self, s):
-        self.progress_msg = s
-        self.emit()
+        # Progress may be updated from build worker threads.
+        self.acquire()
+        try:
+            self.progress_msg = s
+            self.emit()
+        finally:
+            self.release()
 
     def close(self):
         self.clear_last_progress()
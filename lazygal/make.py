@@ -16,20 +16,463 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
+import csv
+import json
 import time
 import shutil
+import contextlib
 import logging
+import threading
+import multiprocessing
+import concurrent.futures
+
+from . import pathutils
 
 
 class CircularDependency(Exception):
     pass
 
 
+class BuildProfile(object):
+    """
+    Accounts for the wall time, the CPU time of the calling thread and the
+    bytes read and written by the calling thread (where the OS tells) spent
+    in each phase of the tasks: "build", "needs_build" checks and
+    "populate_deps". Work sent to worker processes only counts in wall time.
+    Measures exclude the work measured for the tasks made from within the
+    measured one in the same thread, e.g. the dependency checks of
+    needs_build(), so that the totals do not count it twice.
+    """
+
+    PHASES = ("build", "needs_build", "populate_deps")
+    TOP_COUNT = 20
+    IO_STATS_PATH = "/proc/thread-self/io"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.local = threading.local()
+
+    def io_counters(self):
+        try:
+            with open(self.IO_STATS_PATH) as io_fp:
+                counters = dict(line.split(": ") for line in io_fp)
+        except OSError:
+            return None
+        return int(counters["rchar"]), int(counters["wchar"])
+
+    @contextlib.contextmanager
+    def measure(self, task, phase):
+        # Measures running in this thread, each one with the totals of the
+        # measures nested in it: wall, cpu, read, written.
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        nested = [0.0, 0.0, 0, 0]
+        self.local.stack.append(nested)
+
+        io_start = self.io_counters()
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            io_end = self.io_counters()
+            if io_start is None or io_end is None:
+                read = written = None
+            else:
+                read = io_end[0] - io_start[0]
+                written = io_end[1] - io_start[1]
+
+            self.local.stack.pop()
+            if self.local.stack:
+                parent = self.local.stack[-1]
+                parent[0] += wall
+                parent[1] += cpu
+                if read is not None:
+                    parent[2] += read
+                    parent[3] += written
+
+            wall -= nested[0]
+            cpu -= nested[1]
+            if read is not None:
+                read -= nested[2]
+                written -= nested[3]
+
+            path = getattr(task, "_path", None)
+            with self.lock:
+                self.records.append(
+                    {
+                        "task": repr(task),
+                        "class": task.__class__.__name__,
+                        "dir": path and os.path.dirname(path) or "",
+                        "phase": phase,
+                        "wall": wall,
+                        "cpu": cpu,
+                        "read": read,
+                        "written": written,
+                    }
+                )
+
+    def __sum(self, records):
+        totals = {"count": 0, "wall": 0.0, "cpu": 0.0, "read": 0, "written": 0}
+        for record in records:
+            totals["count"] += 1
+            for key in ("wall", "cpu", "read", "written"):
+                if record[key] is not None:
+                    totals[key] += record[key]
+        return totals
+
+    def __group(self, records, key):
+        groups = {}
+        for record in records:
+            groups.setdefault(record[key], []).append(record)
+        return groups
+
+    def report(self):
+        """
+        Returns the totals per phase, per task class and phase, per directory
+        for builds, and the slowest builds.
+        """
+        by_phase = self.__group(self.records, "phase")
+        builds = by_phase.get("build", [])
+        by_class = {}
+        for task_class, records in self.__group(self.records, "class").items():
+            by_class[task_class] = {
+                phase: self.__sum(phase_records)
+                for phase, phase_records in self.__group(records, "phase").items()
+            }
+        return {
+            "phases": {
+                phase: self.__sum(records) for phase, records in by_phase.items()
+            },
+            "classes": by_class,
+            "dirs": {
+                path: self.__sum(records)
+                for path, records in self.__group(builds, "dir").items()
+            },
+            "slowest": sorted(builds, key=lambda r: r["wall"], reverse=True)[
+                : self.TOP_COUNT
+            ],
+        }
+
+    def dump(self, path):
+        """
+        Writes all the measures to path if its extension is .csv, else the
+        report as JSON.
+        """
+        with atomic_open(path, "w", newline="") as report_fp:
+            if os.path.splitext(path)[1].lower() == ".csv":
+                writer = csv.DictWriter(
+                    report_fp,
+                    ("task", "class", "dir", "phase", "wall", "cpu", "read", "written"),
+                )
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                json.dump(self.report(), report_fp, indent=4)
+
+
+class Scheduler(object):
+    """
+    Runs the build of tasks flagged as parallel on a pool of worker threads.
+    Other tasks are built in the calling thread, once all their dependencies
+    are done, unless they do not join them (see MakeTask.join). Parallel
+    tasks are only handed to a worker once their dependencies are built.
+    With a single job, everything is built serially, in place.
+
+    Tasks which queue is "video" run on a separate pool of video_jobs
+    threads, so that long video transcodings neither take turns with other
+    tasks nor exceed their own concurrency limit.
+
+    CPU bound work that does not release the GIL can additionally be sent to
+    a pool of worker processes using call(), and independent work items can
+    be spread on the worker threads using map().
+
+    If fsync is True, outputs written with atomic_path() are flushed to disk
+    before they replace the previous ones. If profile is a BuildProfile, the
+    tasks account for their work in it.
+    """
+
+    def __init__(self, jobs=1, video_jobs=1, fsync=False, profile=None):
+        self.jobs = jobs
+        self.video_jobs = video_jobs
+        self.fsync = fsync
+        self.profile = profile
+        self.executor = None
+        self.executors = {}
+        self.processes = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.writing = set()
+        self.previous = None
+
+    def __enter__(self):
+        global _scheduler
+        if self.jobs > 1:
+            if "fork" in multiprocessing.get_all_start_methods():
+                self.processes = concurrent.futures.ProcessPoolExecutor(
+                    self.jobs, mp_context=multiprocessing.get_context("fork")
+                )
+                # Fork the worker processes now, before any thread is started.
+                self.processes.submit(os.getpid).result()
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+            self.executors["default"] = self.executor
+        if self.jobs > 1 or self.video_jobs > 1:
+            self.executors["video"] = concurrent.futures.ThreadPoolExecutor(
+                self.video_jobs
+            )
+        self.previous = _scheduler
+        _scheduler = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _scheduler
+        try:
+            if exc_type is None:
+                self.wait_all()
+        finally:
+            with self.lock:
+                for future in self.pending.values():
+                    future.cancel()
+                self.pending = {}
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.executor = None
+            self.executors = {}
+            if self.processes is not None:
+                self.processes.shutdown(wait=True)
+                self.processes = None
+            _scheduler = self.previous
+
+    def start_writing(self, tmp_path):
+        with self.lock:
+            self.writing.add(tmp_path)
+
+    def done_writing(self, tmp_path):
+        with self.lock:
+            self.writing.discard(tmp_path)
+
+    def is_writing(self, tmp_path):
+        """
+        Returns whether tmp_path is being written through atomic_path(),
+        e.g. by a task running in the background.
+        """
+        with self.lock:
+            return tmp_path in self.writing
+
+    def in_background(self, task):
+        """
+        Returns whether task is built in the background, see
+        MakeTask.background, rather than before the tasks depending on it.
+        """
+        return task.parallel and task.background and task.queue in self.executors
+
+    def is_scheduled(self, task):
+        with self.lock:
+            return task in self.pending
+
+    def submit(self, task):
+        executor = self.executors.get(task.queue)
+        if executor is None:
+            self.wait(task.deps)
+            task.call_build()
+        else:
+            # Dependencies are always submitted before the tasks depending on
+            # them. The task only goes to a worker once they are built, so
+            # that no worker is held waiting for them.
+            future = concurrent.futures.Future()
+            deps = [f for t, f in self.__futures(task.deps)]
+            remaining = [len(deps)]
+            with self.lock:
+                self.pending[task] = future
+
+            def dep_done(dep_future=None):
+                if dep_future is not None:
+                    with self.lock:
+                        remaining[0] -= 1
+                        if remaining[0] > 0:
+                            return
+                self.__start(executor, task, future, deps)
+
+            if deps:
+                for dep_future in deps:
+                    dep_future.add_done_callback(dep_done)
+            else:
+                dep_done()
+
+    def __start(self, executor, task, future, deps):
+        if not future.set_running_or_notify_cancel():
+            return
+        for dep_future in deps:
+            if dep_future.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+                return
+            elif dep_future.exception() is not None:
+                future.set_exception(dep_future.exception())
+                return
+
+        def build_done(build_future):
+            if build_future.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif build_future.exception() is not None:
+                future.set_exception(build_future.exception())
+            else:
+                future.set_result(None)
+
+        try:
+            executor.submit(task.call_build).add_done_callback(build_done)
+        except RuntimeError as e:
+            # The scheduler is shutting down.
+            future.set_exception(e)
+
+    def __futures(self, tasks, background=False):
+        """
+        Returns the (task, future) pairs of the scheduled tasks among tasks,
+        and among the dependencies of the ones which did not join theirs.
+        Tasks running in the background are skipped, unless background is
+        True.
+        """
+        tasks = list(tasks)
+        seen = set()
+        futures = []
+        while tasks:
+            task = tasks.pop()
+            if task in seen or (task.background and not background):
+                continue
+            seen.add(task)
+            with self.lock:
+                future = self.pending.get(task)
+            if future is not None:
+                futures.append((task, future))
+            elif not task.join:
+                tasks.extend(task.deps)
+        return futures
+
+    def call(self, func, *args):
+        """
+        Returns func(*args), computed in a worker process if there is a pool
+        of those. func and args must therefore be picklable.
+        """
+        if self.processes is None:
+            return func(*args)
+        else:
+            return self.processes.submit(func, *args).result()
+
+    def map(self, func, items):
+        """
+        Returns the list of func(item) for each item, computed on the worker
+        threads if there are some. func must not wait on scheduled tasks.
+        """
+        if self.executor is None:
+            return [func(item) for item in items]
+        else:
+            return list(self.executor.map(func, items))
+
+    def wait(self, tasks, background=False):
+        """
+        Waits for tasks to be built, along with the dependencies of the ones
+        which did not join theirs. Tasks running in the background are
+        skipped, unless background is True.
+        """
+        for task, future in self.__futures(tasks, background):
+            future.result()
+            # Only forget about the task once built, so that it is not
+            # queued again in the meantime.
+            with self.lock:
+                self.pending.pop(task, None)
+
+    def wait_all(self):
+        with self.lock:
+            tasks = list(self.pending.keys())
+        self.wait(tasks, background=True)
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+@contextlib.contextmanager
+def atomic_path(path, fsync=None):
+    """
+    Yields a temporary path to write instead of path. Once written, it
+    replaces path, so that path is never seen partially written, even if
+    lazygal is killed. If an exception is raised, the temporary file is
+    removed and path is left as it was. The extension is kept for the tools
+    guessing the format from it. While it is written, the temporary path is
+    known to the scheduler, so that it is not cleaned up meanwhile.
+    """
+    scheduler = get_scheduler()
+    if fsync is None:
+        fsync = scheduler.fsync
+    root, ext = os.path.splitext(path)
+    tmp_path = "%s.tmp%s" % (root, ext)
+    scheduler.start_writing(tmp_path)
+    try:
+        if os.path.lexists(tmp_path):
+            # Left over by a killed generation, and maybe a link to a source.
+            os.unlink(tmp_path)
+        yield tmp_path
+        if fsync:
+            fd = os.open(tmp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    finally:
+        scheduler.done_writing(tmp_path)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="wb", fsync=None, **kwargs):
+    """
+    Like open(), for writing path through atomic_path().
+    """
+    with atomic_path(path, fsync) as tmp_path:
+        with open(tmp_path, mode, **kwargs) as fp:
+            yield fp
+
+
 class MakeTask(object):
     """
     A simple task that remembers the last time it was built.
     """
 
+    # Slots keep the tasks created for each media small in big directories.
+    # Subclasses which do not define __slots__ still get a __dict__.
+    __slots__ = (
+        "deps",
+        "output_items",
+        "__dep_only",
+        "_deps_populated",
+        "__last_build_time",
+        "__built_once",
+    )
+
+    # Whether build() may run in a worker thread of the Scheduler. This is
+    # only safe for tasks that do not alter the state of other tasks.
+    parallel = False
+    # The Scheduler pool a parallel task runs on.
+    queue = "default"
+    # Whether tasks depending on this parallel one may be built before it is
+    # done, because they do not use its output. It is then only waited for
+    # at the end of the generation.
+    background = False
+    # Whether this task waits for its dependencies to be built before being
+    # built in the calling thread. Tasks which do not use the output of their
+    # dependencies leave it to the tasks depending on them, so that the
+    # dependencies of many of them are built at the same time.
+    join = True
+
     def __init__(self):
         self.deps = []
         self.output_items = []
@@ -38,9 +481,20 @@ class MakeTask(object):
         self._deps_populated = False
         self.update_build_status()
 
+    def profiled(self, phase):
+        """
+        Returns a context manager accounting for the work done in it, if
+        the build is profiled.
+        """
+        profile = get_scheduler().profile
+        if profile is None:
+            return contextlib.nullcontext()
+        return profile.measure(self, phase)
+
     def call_populate_deps(self):
         if not self._deps_populated:
-            self.populate_deps()
+            with self.profiled("populate_deps"):
+                self.populate_deps()
             self._deps_populated = True
 
     def populate_deps(self):
@@ -66,6 +520,14 @@ class MakeTask(object):
     def get_mtime(self):
         return self.__last_build_time
 
+    def get_check_mtime(self):
+        """
+        Returns the last time the output of this task was known to be up to
+        date, which dependencies are compared to. This is the build time,
+        unless the task can tell its output was still the same later on.
+        """
+        return self.get_mtime()
+
     def set_dep_only(self):
         """
         Set this task to being only used as an intermediate work, its output
@@ -104,9 +566,10 @@ class MakeTask(object):
             logging.debug("%s build needed: never built", self)
             return True
 
+        check_mtime = self.get_check_mtime()
         for dependency in self.deps:
             if not dependency.is_dep_only():
-                mtime_gap = dependency.get_mtime() - self.get_mtime()
+                mtime_gap = dependency.get_mtime() - check_mtime
                 if mtime_gap > 0 or dependency.needs_build():
                     logging.debug(
                         "%s build needed: dep %s newer by %ss",
@@ -123,10 +586,23 @@ class MakeTask(object):
 
     def make(self, force=False):
         self.call_populate_deps()
-        if force or self.needs_build():
+        scheduler = get_scheduler()
+        if scheduler.is_scheduled(self):
+            return  # already queued by another depending task
+        if force:
+            needs_build = True
+        else:
+            with self.profiled("needs_build"):
+                needs_build = self.needs_build()
+        if needs_build:
             for d in self.deps:
                 d.make()  # dependency building not forced
-            self.call_build()
+            if self.parallel:
+                scheduler.submit(self)
+            else:
+                if self.join:
+                    scheduler.wait(self.deps)
+                self.call_build()
 
     def call_build(self):
         """
@@ -135,7 +611,8 @@ class MakeTask(object):
         to setup some state before and/or after build.
         """
         try:
-            self.build()
+            with self.profiled("build"):
+                self.build()
         except KeyboardInterrupt:
             self.clean_output()
             raise
@@ -185,6 +662,10 @@ class GroupTask(MakeTask):
     A class that builds nothing but groups subtasks.
     """
 
+    # Nothing is built from the deps, so the tasks depending on this group
+    # wait for them instead.
+    join = False
+
     def built_once(self):
         return True  # GroupTask is all about the deps.
 
@@ -217,6 +698,8 @@ class FileMakeObject(MakeTask):
     A generic task to build a file.
     """
 
+    __slots__ = ("_path",)
+
     def __init__(self, path):
         self._path = path
         super().__init__()
@@ -230,6 +713,19 @@ class FileMakeObject(MakeTask):
         else:
             self.stamp_delete()
 
+    def output_path(self):
+        """
+        Returns a context manager yielding the temporary path to write the
+        output to, see atomic_path().
+        """
+        return atomic_path(self._path)
+
+    def open_output(self, mode="wb", **kwargs):
+        """
+        Returns the output file opened for writing, see atomic_open().
+        """
+        return atomic_open(self._path, mode, **kwargs)
+
     def clean_output(self):
         if os.path.lexists(self._path):
             os.unlink(self._path)
@@ -243,10 +739,17 @@ class FileSimpleDependency(FileMakeObject):
     Simple file dependency that needn't build. It just should be there.
     """
 
+    __slots__ = ()
+
     def __init__(self, path):
         super().__init__(path)
         assert self.built_once(), path
 
+    def register_output(self, output):
+        # The file is a source of the build, not an output of it. Listing it
+        # in the outputs of all the depending tasks would only take memory.
+        pass
+
     def build(self):
         pass
 
@@ -254,21 +757,48 @@ class FileSimpleDependency(FileMakeObject):
         pass
 
 
+# How FileCopy targets may share their data with the source.
+LINK_MODES = ("copy", "hardlink", "reflink", "auto")
+
+
 class FileCopy(FileMakeObject):
     """
-    Simple file copy make target.
+    Simple file copy make target. Unless link is 'copy', a hard link or a
+    reflink to the source is tried first, falling back to a plain copy.
+
+    A hard link has the mtime of the source, which is not newer than the
+    source, so it does not need a build until the source is replaced.
     """
 
-    def __init__(self, src, dst):
+    def __init__(self, src, dst, link="copy"):
         self.src = src
         self.path = dst
+        self.link = link
         super().__init__(dst)
         self.add_file_dependency(self.src)
 
     def build(self):
-        if os.path.islink(self.path):
-            os.remove(self.path)
-        shutil.copyfile(self.src, self.path)
+        # The destination is replaced, not written to, so that the source
+        # is left alone if the destination is a link to it.
+        with self.output_path() as tmp_path:
+            self.copy(tmp_path)
+
+    def copy(self, dst):
+        if self.link in ("hardlink", "auto"):
+            try:
+                os.link(self.src, dst)
+                return
+            except OSError as e:
+                logging.debug("Cannot hard link %s: %s", self.src, e)
+
+        if self.link in ("reflink", "auto"):
+            try:
+                pathutils.clone_file(self.src, dst)
+                return
+            except OSError as e:
+                logging.debug("Cannot reflink %s: %s", self.src, e)
+
+        shutil.copyfile(self.src, dst)
 
 
 class FileSymlink(FileMakeObject):
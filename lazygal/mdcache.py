@@ -0,0 +1,157 @@
+# Lazygal, a lazy static web gallery generator.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from .pindex import json_serializer
+
+
+class MetadataCache(object):
+    """
+    Album wide store of the metadata read from source media files, in a
+    single SQLite database. Entries are keyed by source directory and
+    filename, and are only valid for the mtime and size the media file had
+    when its metadata was read.
+
+    It only spares reading media files again when the index of their web
+    gallery directory (see pindex.PersistentIndex) is stale or missing, e.g.
+    when generating into a new output directory. Up to date directory
+    indexes are still read from their index.json files.
+
+    All the entries of a directory are fetched in a single query.
+
+    The scan journal of the source tree (see pathutils.ScanJournal) is also
+    kept there.
+    """
+
+    version = 2
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.db = sqlite3.connect(self.path)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            logging.debug("Initializing metadata cache %s", self.path)
+            self.db.execute("DROP TABLE IF EXISTS media")
+            self.db.execute("DROP TABLE IF EXISTS dirs")
+            self.db.execute("""CREATE TABLE media (
+                    dir TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    md TEXT NOT NULL,
+                    PRIMARY KEY (dir, filename)
+                )""")
+            self.db.execute("""CREATE TABLE dirs (
+                    path TEXT PRIMARY KEY,
+                    mtime INTEGER NOT NULL,
+                    listing TEXT NOT NULL
+                )""")
+            self.db.execute("PRAGMA user_version = %d" % self.version)
+            self.db.commit()
+
+    @staticmethod
+    def __decode(md_json):
+        md = json.loads(md_json)
+        # Dates are the only non JSON types in media metadata.
+        for d in (md, md["metadata"]):
+            if d.get("date") is not None:
+                d["date"] = datetime.datetime.fromisoformat(d["date"])
+        return md
+
+    def load_dir(self, dir_path):
+        """
+        Returns a dict mapping the filenames of the media files of dir_path
+        to their cached (mtime, size, md).
+        """
+        rows = self.db.execute(
+            "SELECT filename, mtime, size, md FROM media WHERE dir = ?", (dir_path,)
+        )
+        return {
+            filename: (mtime, size, md_json) for filename, mtime, size, md_json in rows
+        }
+
+    def lookup(self, cached, media):
+        """
+        Returns the metadata of media from a load_dir() result, or None if
+        it is missing or stale.
+        """
+        try:
+            mtime, size, md_json = cached[media.filename]
+        except KeyError:
+            return None
+
+        st = os.stat(media.path)
+        if mtime != st.st_mtime or size != st.st_size:
+            return None
+        return self.__decode(md_json)
+
+    def store(self, dir_path, medias, removed=()):
+        """
+        Stores the metadata of medias, all located in dir_path, and forgets
+        the removed filenames of dir_path.
+        """
+        rows = []
+        for media in medias:
+            st = os.stat(media.path)
+            md_json = json.dumps(media.md, default=json_serializer)
+            rows.append((dir_path, media.filename, st.st_mtime, st.st_size, md_json))
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.db.executemany(
+                "DELETE FROM media WHERE dir = ? AND filename = ?",
+                [(dir_path, filename) for filename in removed],
+            )
+
+    def load_scan_journal(self):
+        """
+        Returns the scan journal entries.
+        """
+        entries = {}
+        for path, mtime_ns, listing in self.db.execute("SELECT * FROM dirs"):
+            dirs, links, files = json.loads(listing)
+            entries[path] = (mtime_ns, dirs, links, files)
+        return entries
+
+    def store_scan_journal(self, journal):
+        """
+        Stores the changes of journal, and forgets the media files of the
+        removed directories.
+        """
+        rows = [
+            (path, mtime_ns, json.dumps((dirs, links, files)))
+            for path, (mtime_ns, dirs, links, files) in journal.updated.items()
+        ]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", rows)
+            removed = [(path,) for path in journal.removed()]
+            self.db.executemany("DELETE FROM dirs WHERE path = ?", removed)
+            self.db.executemany("DELETE FROM media WHERE dir = ?", removed)
+        journal.updated = {}
+
+    def close(self):
+        self.db.close()
+
+
+# vim: ts=4 sw=4 expandtab
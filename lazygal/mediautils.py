@@ -16,6 +16,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import array
+import itertools
 import json
 import logging
 import math
@@ -27,11 +29,20 @@ import tempfile
 
 from PIL import Image as PILImage
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class VideoError(Exception):
     pass
 
 
+class VideoTranscodeError(VideoError):
+    pass
+
+
 FFMPEG = shutil.which("ffmpeg")
 FFPROBE = shutil.which("ffprobe")
 HAVE_VIDEO = FFMPEG and FFPROBE
@@ -75,19 +86,26 @@ class VideoProcessor(object):
                 position = 0
             percent = math.floor(100 * position / self.duration)
             if self.progress:
-                self.progress.set_task_progress(percent)
+                self.progress.set_task_progress(percent, self.input_file)
             else:
                 logging.info("progress: %d%%" % percent)
 
-    def convert(self, outfile):
+    def input_cmd(self):
         runcmd = [FFMPEG]
         runcmd.extend(self.global_opts)
         runcmd.extend(self.input_file_opts)
         runcmd.extend(["-i", self.input_file])
+        return runcmd
+
+    def convert(self, outfile):
+        runcmd = self.input_cmd()
         if self.videofilters:
             runcmd.extend(["-vf", ",".join(self.videofilters)])
         runcmd.extend(self.output_file_opts)
         runcmd.append(outfile)
+        self.run(runcmd)
+
+    def run(self, runcmd):
         logging.debug("RUNNING %s" % " ".join(runcmd))
         with subprocess.Popen(
             runcmd,
@@ -104,6 +122,43 @@ class VideoProcessor(object):
             raise VideoError("%s failed" % " ".join(runcmd))
 
 
+class SplitVideoProcessor(VideoProcessor):
+    """
+    Runs several video processors on a single decoding of the input file,
+    using a split filter graph. Audio is only mapped to the first output.
+    """
+
+    def __init__(self, input_file, processors):
+        super().__init__(input_file)
+        self.processors = processors
+        for processor in self.processors:
+            if processor.progress is not None:
+                # Report to the progress of the transcoding, if any.
+                self.set_progress(processor.progress)
+
+    def convert(self, outfiles):
+        graph = [
+            "[0:v]split=%d%s"
+            % (
+                len(self.processors),
+                "".join("[in%d]" % i for i in range(len(self.processors))),
+            )
+        ]
+        for i, processor in enumerate(self.processors):
+            filters = ",".join(processor.videofilters) or "null"
+            graph.append("[in%d]%s[out%d]" % (i, filters, i))
+
+        runcmd = self.input_cmd()
+        runcmd.extend(["-filter_complex", ";".join(graph)])
+        for i, (processor, outfile) in enumerate(zip(self.processors, outfiles)):
+            runcmd.extend(["-map", "[out%d]" % i])
+            if i == 0:
+                runcmd.extend(["-map", "0:a?"])
+            runcmd.extend(processor.output_file_opts)
+            runcmd.append(outfile)
+        self.run(runcmd)
+
+
 class VideoInfo(object):
 
     def __init__(self, path):
@@ -178,16 +233,116 @@ class VideoFramesExtractor(VideoProcessor):
 
     def convert(self, outfile):
         super(VideoFramesExtractor, self).convert(outfile)
+        self.check_output(outfile)
+
+    def check_output(self, outfile):
         if not os.path.isfile(outfile % 1):
             # some ffmpeg version do not extract any frame but do not exit
             # with return code
             raise VideoError("no frame extracted")
 
 
+class FrameHistograms(object):
+    """
+    RGB histograms of candidate frames, normalized by the frame pixel count,
+    and held in a single (frames x bins) NumPy array, or in a flat array of
+    doubles if NumPy is not available.
+    """
+
+    BINS = 3 * 256
+    # Rec. 601 luma weights of the R, G and B channels
+    LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+    def __init__(self, images):
+        self.paths = list(images)
+        if numpy is not None:
+            self.data = numpy.empty((len(self.paths), self.BINS))
+        else:
+            self.data = array.array("d")
+
+        for index, path in enumerate(self.paths):
+            with open(path, "rb") as im_fp:
+                im = PILImage.open(im_fp)
+                if im.mode != "RGB":
+                    im = im.convert("RGB")
+                pixels = float(im.width * im.height)
+                histogram = im.histogram()
+            if numpy is not None:
+                self.data[index] = histogram
+                self.data[index] /= pixels
+            else:
+                self.data.extend(value / pixels for value in histogram)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def rows(self):
+        for index in range(len(self)):
+            yield self.data[index * self.BINS : (index + 1) * self.BINS]
+
+    @classmethod
+    def channels(cls, histogram):
+        return [histogram[c * 256 : (c + 1) * 256] for c in range(3)]
+
+    def mse(self):
+        """
+        Returns the mean squared error of each histogram to the average one.
+        """
+        if numpy is not None:
+            gaps = self.data - self.data.mean(axis=0)
+            return (gaps * gaps).sum(axis=1) / self.BINS
+
+        average = [math.fsum(values) / len(self) for values in zip(*self.rows())]
+        return [
+            math.fsum((a - v) * (a - v) for a, v in zip(average, row)) / self.BINS
+            for row in self.rows()
+        ]
+
+    def perceptual(self):
+        """
+        Returns the distance of each histogram to the average one, as the
+        earth mover's distance between the cumulated histograms of each
+        channel, weighted by the channel contribution to luminance. Unlike
+        bin to bin distances, this accounts for how far colours shifted.
+        """
+        if numpy is not None:
+            cumulated = self.data.reshape((len(self), 3, 256)).cumsum(axis=2)
+            gaps = numpy.abs(cumulated - cumulated.mean(axis=0)).sum(axis=2)
+            return gaps.dot(self.LUMA_WEIGHTS)
+
+        cumulated = [
+            list(
+                itertools.chain.from_iterable(
+                    itertools.accumulate(c) for c in self.channels(row)
+                )
+            )
+            for row in self.rows()
+        ]
+        average = [math.fsum(values) / len(self) for values in zip(*cumulated)]
+        average = self.channels(average)
+        distances = []
+        for row in cumulated:
+            distances.append(
+                math.fsum(
+                    weight * math.fsum(abs(a - v) for a, v in zip(avg_c, c))
+                    for weight, avg_c, c in zip(
+                        self.LUMA_WEIGHTS, average, self.channels(row)
+                    )
+                )
+            )
+        return distances
+
+
 class VideoThumbnailer(object):
 
-    def __init__(self, video):
+    METRICS = ("mse", "perceptual")
+
+    def __init__(self, video, frames=10, metric="mse"):
         self.video = video
+        self.frames = frames
+        if metric not in self.METRICS:
+            raise ValueError("unknown video thumbnail metric '%s'" % metric)
+        self.metric = metric
 
     def find_most_representative(self, images):
         images = list(images)
@@ -197,40 +352,20 @@ class VideoThumbnailer(object):
         if len(images) == 1:
             return images[0]
 
-        histograms = []
-        for path in images:
-            with open(path, "rb") as im_fp:
-                im = PILImage.open(im_fp)
-                histograms.append((path, im.histogram()))
-
-        n_samples = len(histograms)
-        n_values = len(histograms[0][1])
-
-        # Average each histogram value
-        average_hist = []
-        for value_index in range(n_values):
-            average = 0.0
-            for path, histogram in histograms:
-                average = average + (float(histogram[value_index]) / n_samples)
-            average_hist.append(average)
+        histograms = FrameHistograms(images)
+        distances = getattr(histograms, self.metric)()
 
         # Find histogram closest to average histogram
-        min_mse = None
-        best_frame_no = 0
-        for hist_index in range(len(histograms)):
-            hist = histograms[hist_index][1]
-            mse = 0.0
-            for value_index in range(n_values):
-                gap = average_hist[value_index] - hist[value_index]
-                mse = mse + gap * gap
-
-            if min_mse is None or mse < min_mse:
-                min_mse = mse
-                best_frame_no = hist_index
-
-        return histograms[best_frame_no][0]
-
-    def convert(self, outfile, resize=None):
+        best_frame_no = min(range(len(histograms)), key=lambda i: distances[i])
+        return histograms.paths[best_frame_no]
+
+    def convert(self, outfile, resize=None, transcoder=None, transcoded_file=None):
+        """
+        Writes the most representative frame of the video to outfile. If a
+        transcoder is supplied, transcoded_file is also produced from the
+        same decoding of the video, and this may raise VideoTranscodeError
+        while the thumbnail was successfully written.
+        """
         tmpdir = tempfile.mkdtemp(prefix="lazygal-")
 
         try:
@@ -238,11 +373,25 @@ class VideoThumbnailer(object):
                 tmpdir, "%s_%%s_%%%%d.jpg" % os.path.basename(self.video)
             )
 
+            transcode_error = None
             try:
-                fextractor = VideoFramesExtractor(self.video, resize)
-                fextractor.convert(tmpimg_name % "scene")
+                fextractor = VideoFramesExtractor(
+                    self.video, resize, frames=self.frames
+                )
+                if transcoder is None:
+                    fextractor.convert(tmpimg_name % "scene")
+                else:
+                    try:
+                        SplitVideoProcessor(
+                            self.video, [transcoder, fextractor]
+                        ).convert([transcoded_file, tmpimg_name % "scene"])
+                    except VideoError as e:
+                        transcode_error = VideoTranscodeError(str(e))
+                    fextractor.check_output(tmpimg_name % "scene")
             except VideoError as e:
-                fextractor = VideoFramesExtractor(self.video, resize, scene=False)
+                fextractor = VideoFramesExtractor(
+                    self.video, resize, scene=False, frames=self.frames
+                )
                 fextractor.convert(tmpimg_name % "noscene")
 
             best = self.find_most_representative(
@@ -251,6 +400,9 @@ class VideoThumbnailer(object):
             if not best:
                 raise VideoError("no best frame found")
             shutil.copyfile(best, outfile)
+
+            if transcode_error is not None:
+                raise transcode_error
         except VideoError:
             raise
         finally:
@@ -598,12 +598,9 @@ class DirectoryMetadata(make.GroupTask):
 
         # Add album picture
         if "album_picture" not in result:
-            try:
-                if dir is not None:
-                    picture = dir.get_all_medias_paths()[0]
-                else:
-                    raise IndexError
-            except IndexError:
+            if dir is not None:
+                picture = next(dir.iter_all_medias_paths(), None)
+            else:
                 picture = None
             if picture is not None:
                 result["album_picture"] = os.path.relpath(picture, dir.path)
@@ -648,7 +645,7 @@ class DefaultMetadata(make.FileMakeObject):
 
         logging.info(_("GEN %s"), self._path)
 
-        with codecs.open(self._path, "w", FILE_METADATA_ENCODING) as f:
+        with self.open_output("w", encoding=FILE_METADATA_ENCODING) as f:
             f.write("# Directory metadata for lazygal, Matew format\n")
             f.write('Album name "%s"\n' % self.source_dir.human_name)
             f.write('Album description ""\n')
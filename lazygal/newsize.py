@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import functools
 import types
 import re
 import math
@@ -192,7 +193,12 @@ for name, obj in list(globals().items()):
         resize_patterns.append(obj)
 
 
+@functools.lru_cache(maxsize=None)
 def get_newsizer(resize_string):
+    """
+    Returns the newsizer for resize_string. Newsizers do not change once
+    created, so all the galleries using the same size share one.
+    """
     for newsizer_class in resize_patterns:
         newsizer = newsizer_class(resize_string)
         try:
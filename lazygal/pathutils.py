@@ -19,10 +19,21 @@
 
 import os
 import sys
+import time
 import posixpath
 import logging
+import shutil
 import urllib.parse as urlparse
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+# ioctl sharing the data blocks of a file with another one, from linux/fs.h
+FICLONE = 0x40049409
+
 
 def is_root_posix(path):
     return path == "/"
@@ -99,6 +110,44 @@ def url_quote(url, anchor=""):
     return "".join(tokens)
 
 
+def clone_file(src, dst):
+    """
+    Creates dst as a reflink of src, sharing its data blocks, or else as an
+    in-kernel copy, which some filesystems also turn into a reflink. Raises
+    OSError if none of those is supported, or if the copy ends short.
+    """
+    with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+        src_fd, dst_fd = src_fp.fileno(), dst_fp.fileno()
+        try:
+            if fcntl is None:
+                raise OSError("reflinks are not supported")
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            if not hasattr(os, "copy_file_range"):
+                raise
+
+        remaining = os.fstat(src_fd).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src_fd, dst_fd, remaining)
+            if copied == 0:
+                # The source shrank, or the filesystem gave up.
+                raise OSError("%s: copy ended %d bytes short" % (src, remaining))
+            remaining = remaining - copied
+
+
+def copy_file(src, dst):
+    """
+    Copies src to dst, sharing its data blocks if the filesystem supports
+    it, see clone_file().
+    """
+    try:
+        clone_file(src, dst)
+    except OSError as e:
+        logging.debug("Cannot reflink %s: %s", src, e)
+        shutil.copyfile(src, dst)
+
+
 def walk(top, walked=None, topdown=False):
     """
     This is a wrapper around os.walk() from the standard library:
@@ -129,6 +178,101 @@ def walk(top, walked=None, topdown=False):
         yield root, dirs, files
 
 
+class ScanJournal(object):
+    """
+    Remembers the listing of directories, and the directory mtime it is
+    valid for. walk() then only lists again the directories which mtime
+    changed, the other ones only cost a stat() call.
+
+    Entries map directory paths to (mtime_ns, dirs, links, files) tuples,
+    links being the subset of dirs which are symbolic links. Entries which
+    changed are also kept in updated, until the caller clears it.
+
+    Only directories are journaled. The size and mtime of the files are not
+    recorded here: the metadata cache checks them for the media files.
+    """
+
+    # Directories modified this close to the listing time may be modified
+    # again within the same mtime tick, their listing is not remembered.
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.updated = {}
+        self.visited = set()
+        self.started = None
+
+    def listdir(self, path):
+        st = os.stat(path)
+        self.visited.add(path)
+        try:
+            mtime_ns, dirs, links, files = self.entries[path]
+        except KeyError:
+            pass
+        else:
+            if mtime_ns == st.st_mtime_ns:
+                return list(dirs), list(links), list(files)
+
+        dirs, links, files = [], [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry.name)
+                    if entry.is_symlink():
+                        links.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        if st.st_mtime_ns < self.started - self.RACY_NS:
+            entry = (st.st_mtime_ns, dirs, links, files)
+            self.entries[path] = self.updated[path] = entry
+        else:
+            self.entries.pop(path, None)
+        return list(dirs), list(links), list(files)
+
+    def walk(self, top):
+        """
+        Same as walk(top), bottom-up.
+        """
+        self.started = time.time_ns()
+        self.visited = set()
+        return self.__walk(top, set())
+
+    def __walk(self, top, walked):
+        walked.add(os.path.realpath(top))
+        try:
+            dirs, links, files = self.listdir(top)
+        except OSError:
+            return
+
+        for d in dirs:
+            if d not in links:
+                yield from self.__walk(os.path.join(top, d), walked)
+
+        # Follow symlinks if they have not been walked yet
+        for d in links:
+            d_path = os.path.join(top, d)
+            if os.path.realpath(d_path) not in walked:
+                yield from self.__walk(d_path, walked)
+            else:
+                logging.error(
+                    "Not following symlink '%s' because directory has already been processed.",
+                    d_path,
+                )
+
+        yield top, dirs, files
+
+    def removed(self):
+        """
+        Returns the known directories which were not found by the last walk().
+        """
+        return [path for path in self.entries if path not in self.visited]
+
+
 def walk_and_do(top=None, walked=None, dcb=None, fcb=None, topdown=False):
     """
     This walk calls dcb on each found directory and fcb on each found
@@ -19,8 +19,10 @@
 import logging
 import os
 import json
+import hashlib
 import collections
 import datetime
+import threading
 
 from . import make
 from . import tplvars
@@ -32,6 +34,53 @@ def json_serializer(obj):
     raise TypeError("Type %s is not JSON serializable", type(obj))
 
 
+def file_digest(path, blocksize=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_digest(content):
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+# The webgal options which only change the generated medias, not the pages.
+# The build index checks those against the recipes of the generated medias.
+MEDIA_OPTIONS = (
+    "jpeg-quality",
+    "jpeg-optimize",
+    "jpeg-progressive",
+    "thumbnail-resample",
+    "video-thumbnail-frames",
+    "video-thumbnail-metric",
+)
+
+
+def config_data(config, media_options):
+    """
+    Returns the webgal options of config which are in MEDIA_OPTIONS if
+    media_options is True, or the other ones otherwise, as JSON data.
+    """
+    return {
+        "webgal": {
+            option: value
+            for option, value in config["webgal"].items()
+            if (option in MEDIA_OPTIONS) == media_options
+        }
+    }
+
+
+def config_differs(config, previous, media_options):
+    current = config_data(config, media_options)
+    current, previous = (
+        json.dumps(c, sort_keys=True, default=json_serializer)
+        for c in (current, previous)
+    )
+    return current != previous
+
+
 def datetime_hook(json_dict):
     for key, value in json_dict.items():
         if type(value) is str:
@@ -45,7 +94,8 @@ def datetime_hook(json_dict):
 class JSONWebFile(make.FileMakeObject):
 
     def __init__(self, webgal):
-        super().__init__(os.path.join(webgal.path, self.json_filename))
+        self.path = os.path.join(webgal.path, self.json_filename)
+        super().__init__(self.path)
         self.webgal = webgal
 
         self.data = None
@@ -68,7 +118,7 @@ class JSONWebFile(make.FileMakeObject):
         self.data["version"] = self.version
 
     def dump(self):
-        with open(self._path, "w") as json_fp:
+        with self.open_output("w") as json_fp:
             if self.webgal.config.get("runtime", "debug"):
                 indent = 4
             else:
@@ -95,9 +145,7 @@ class PersistentIndex(JSONWebFile):
     def _init_data(self):
         super()._init_data()
 
-        self.data["config"] = {
-            "webgal": dict(self.webgal.config["webgal"]),
-        }
+        self.data["config"] = self.__config_data()
 
         self.data["count"] = {
             "media": 0,
@@ -114,7 +162,25 @@ class PersistentIndex(JSONWebFile):
 
         self.data["medias"] = {}
 
+    def __config_data(self):
+        return config_data(self.webgal.config, False)
+
+    def config_changed(self):
+        """
+        Returns True if the options affecting the pages changed since the
+        last dump.
+        """
+        return config_differs(self.webgal.config, self.data["config"], False)
+
+    def needs_build(self):
+        if self.config_changed():
+            logging.debug("%s build needed: config changed", self)
+            return True
+        return super().needs_build()
+
     def __populate_data(self):
+        self.data["config"] = self.__config_data()
+
         # reset counts
         for t in ("media", "image", "video", "subgal"):
             self.data["count"][t] = 0
@@ -137,6 +203,12 @@ class PersistentIndex(JSONWebFile):
             "video": self.data["count"]["video"],
         }
 
+        latest = {"date": None, "mtime": None}
+        for media in self.webgal.source_dir.medias:
+            if media.has_reliable_date():
+                self.__update_latest(latest, "date", media.get_date_taken().timestamp())
+            self.__update_latest(latest, "mtime", media.get_datetime().timestamp())
+
         self.data["count"]["subgal"] = len(self.webgal.subgals)
         self.data["subgals"] = []
         for subgal in self.webgal.subgals:
@@ -145,9 +217,41 @@ class PersistentIndex(JSONWebFile):
                     self.data["all_count"][count_type]
                     + subgal.pindex.data["all_count"][count_type]
                 )
+            for stamp_type, stamp in subgal.pindex.latest_stamps().items():
+                self.__update_latest(latest, stamp_type, stamp)
 
             self.data["subgals"].append(subgal.source_dir.name)
 
+        self.data["latest"] = latest
+
+    @staticmethod
+    def __update_latest(latest, stamp_type, stamp):
+        if stamp is not None and (
+            latest[stamp_type] is None or stamp > latest[stamp_type]
+        ):
+            latest[stamp_type] = stamp
+
+    def latest_stamps(self):
+        """
+        Returns the latest reliable date and the latest mtime of the medias
+        in this directory and below, as timestamps or None. Those are
+        aggregated from the subdirectories indexes when this one is built.
+        """
+        if "latest" not in self.data:
+            # Dumped by a previous version
+            date, mtime = self.webgal.source_dir.latest_media_stamps()
+            return {"date": date, "mtime": mtime}
+        return self.data["latest"]
+
+    def latest_media_stamp(self):
+        """
+        Returns the same as Directory.latest_media_stamp().
+        """
+        latest = self.latest_stamps()
+        if latest["date"] is None:
+            return latest["mtime"]
+        return latest["date"]
+
     def load_media(self, src_media):
         if self.webgal.skip_media(src_media):
             return
@@ -206,6 +310,220 @@ class PersistentIndex(JSONWebFile):
         return self.data["count"][media_type]
 
 
+class PersistentIndexSummary(make.MakeTask):
+    """
+    What is kept of a PersistentIndex once its web gallery is generated in
+    streaming mode: its counts and latest stamps, which the index above
+    aggregates, and the time it was last built, which that index depends on.
+    """
+
+    def __init__(self, pindex):
+        super().__init__()
+        if pindex.built_once():
+            self.stamp_build(pindex.get_mtime())
+
+        self.data = {
+            "count": pindex.data["count"],
+            "all_count": pindex.data["all_count"],
+            "latest": pindex.latest_stamps(),
+        }
+
+    def latest_stamps(self):
+        return self.data["latest"]
+
+    def latest_media_stamp(self):
+        latest = self.latest_stamps()
+        if latest["date"] is None:
+            return latest["mtime"]
+        return latest["date"]
+
+    def get_media_count(self, media_type="media"):
+        return self.data["count"][media_type]
+
+    def build(self):
+        pass
+
+
+class BuildIndex(JSONWebFile):
+    """
+    Remembers what each generated media file was built from: its generation
+    parameters, and in checksum mode the digest of its source. A generated
+    file which parameters changed in the configuration is built again, and
+    in checksum mode a generated file which source only got a newer mtime
+    (e.g. after a restore from backup) does not need to be built again.
+
+    It also remembers the digest of the web pages, so that pages which
+    contents did not change are not written again.
+    """
+
+    json_filename = "build.json"
+    version = 2
+
+    def __init__(self, webgal):
+        super().__init__(webgal)
+        self.checksum = self.webgal.config.get("runtime", "checksum")
+        self.changed = False
+        # Records are added from the worker threads.
+        self.lock = threading.Lock()
+
+    def _init_data(self):
+        super()._init_data()
+        self.data["config"] = None
+        self.data["sources"] = {}
+        self.data["outputs"] = {}
+        self.data["pages"] = {}
+
+    def source_digest(self, src_media):
+        """
+        Returns the digest of the source media contents. The file is only
+        read if its size or mtime changed since the digest was computed.
+        """
+        st = os.stat(src_media.path)
+        known = self.data["sources"].get(src_media.filename)
+        if known and known["mtime"] == st.st_mtime and known["size"] == st.st_size:
+            return known["digest"]
+
+        digest = file_digest(src_media.path)
+        with self.lock:
+            self.data["sources"][src_media.filename] = {
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "digest": digest,
+            }
+            self.changed = True
+        return digest
+
+    def __output_record(self, output):
+        record = {"recipe": output.get_recipe()}
+        if self.checksum:
+            record["source"] = self.source_digest(output.source_media)
+        return record
+
+    def is_up_to_date(self, output):
+        """
+        In checksum mode, returns True if output was built from the same
+        source contents and with the same recipe.
+        """
+        if not self.checksum:
+            return False
+
+        record = self.data["outputs"].get(output.filename)
+        return (
+            record is not None
+            and "source" in record
+            and os.path.isfile(output.path)
+            and record == self.__output_record(output)
+        )
+
+    def config_changed(self):
+        """
+        Returns True if the options which only change the generated medias
+        (see MEDIA_OPTIONS) changed since the last dump.
+        """
+        return config_differs(self.webgal.config, self.data.get("config"), True)
+
+    def lacks_digests(self):
+        """
+        Returns True if in checksum mode some outputs were recorded without
+        the digest of their source, e.g. before checksum mode was enabled.
+        """
+        return self.checksum and any(
+            "source" not in record for record in self.data["outputs"].values()
+        )
+
+    def needs_record(self, output):
+        """
+        Returns True if output is not recorded, or if in checksum mode its
+        record lacks the digest of its source (e.g. it was recorded before
+        checksum mode was enabled).
+        """
+        record = self.data["outputs"].get(output.filename)
+        return record is None or (self.checksum and "source" not in record)
+
+    def recipe_changed(self, output):
+        """
+        Returns True if output was built with another recipe than the one
+        currently configured. An output built before it was recorded is
+        assumed to be built with the current one.
+        """
+        record = self.data["outputs"].get(output.filename)
+        return record is not None and record["recipe"] != output.get_recipe()
+
+    def record(self, output):
+        record = self.__output_record(output)
+        with self.lock:
+            if self.data["outputs"].get(output.filename) != record:
+                self.data["outputs"][output.filename] = record
+                self.changed = True
+
+    def __page_record(self, page):
+        record = self.data["pages"].get(page.filename)
+        if record is None:
+            return None
+        try:
+            st = os.stat(page.path)
+        except FileNotFoundError:
+            return None
+        if record["mtime"] != st.st_mtime or record["size"] != st.st_size:
+            return None  # changed by someone else
+        return record
+
+    def page_record(self, page):
+        """
+        Returns what was recorded when page was last written, or None if
+        it does not exist. If the page file changed since, only the digest
+        of its contents is returned.
+        """
+        record = self.__page_record(page)
+        if record is None and os.path.isfile(page.path):
+            record = {"digest": file_digest(page.path)}
+        return record
+
+    def page_check_time(self, page):
+        """
+        Returns the last time page was rendered, even if it was not written
+        because its contents did not change, or None if unknown.
+        """
+        record = self.__page_record(page)
+        return record and record["checked"]
+
+    def record_page(self, page, digest, generated, check_time):
+        st = os.stat(page.path)
+        gen_datetime, gen_date = generated
+        with self.lock:
+            self.data["pages"][page.filename] = {
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "digest": digest,
+                "gen_datetime": gen_datetime,
+                "gen_date": gen_date,
+                "checked": check_time,
+            }
+            self.changed = True
+
+    def needs_build(self):
+        if not os.path.isdir(self.webgal.path):
+            return False  # nothing generated
+        return self.changed or self.config_changed()
+
+    def build(self):
+        logging.info("  DUMPJSON %s", self.json_filename)
+
+        with self.lock:
+            self.data["config"] = config_data(self.webgal.config, True)
+
+            for filename in list(self.data["sources"].keys()):
+                if filename not in self.webgal.source_dir.medias_names:
+                    del self.data["sources"][filename]
+            for records in (self.data["outputs"], self.data["pages"]):
+                for filename in list(records.keys()):
+                    if not os.path.isfile(os.path.join(self.webgal.path, filename)):
+                        del records[filename]
+
+            self.dump()
+            self.changed = False
+
+
 class WebAssets(JSONWebFile):
 
     json_filename = "webassets.json"
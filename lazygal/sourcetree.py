@@ -21,13 +21,14 @@ import locale
 import logging
 import datetime
 import os
+import random
 import re
 import time
 
 from PIL import Image as PILImage
 
 from . import pathutils, make, metadata
-from . import mediautils
+from . import mediautils, eyecandy
 
 
 SOURCEDIR_CONFIGFILE = ".lazygal"
@@ -35,6 +36,8 @@ SOURCEDIR_CONFIGFILE = ".lazygal"
 
 class File(make.FileSimpleDependency):
 
+    __slots__ = ("path", "album", "filename", "name", "extension")
+
     def __init__(self, path, album):
         super().__init__(path)
 
@@ -114,6 +117,14 @@ class File(make.FileSimpleDependency):
 
 class MediaFile(File):
 
+    __slots__ = (
+        "broken",
+        "md",
+        "__md_loaded",
+        "__md_extracted",
+        "comment_file_path",
+    )
+
     def __init__(self, path, album):
         super().__init__(path, album)
         self.broken = False
@@ -125,6 +136,7 @@ class MediaFile(File):
             },
         }
         self.__md_loaded = False
+        self.__md_extracted = False
 
         comment_file_path = self.path + metadata.FILE_METADATA_MEDIA_SUFFIX
         if os.path.isfile(comment_file_path):
@@ -140,19 +152,49 @@ class MediaFile(File):
             mdloader = None
         self._parse_metadata(mdloader)
 
+    def metadata_in_index(self, pindex):
+        return (
+            self.get_mtime() < pindex.get_mtime()
+            and self.filename in pindex.data["medias"]
+        )
+
+    def needs_metadata_extraction(self, pindex):
+        """
+        Returns True if metadata has to be read from the media file, because
+        it is not up to date in pindex.
+        """
+        if self.__md_loaded or self.__md_extracted:
+            return False
+        return not pindex or not self.metadata_in_index(pindex)
+
+    def extract_metadata(self):
+        """
+        Reads metadata from the media file. This only touches this media, and
+        can therefore run in a worker thread.
+        """
+        self.load_metadata_from_mediafile()
+        self.__md_extracted = True
+
+    def set_extracted_metadata(self, md):
+        """
+        Uses md, read earlier from this media file, as the result of
+        extract_metadata().
+        """
+        self.md = md
+        self.__md_extracted = True
+
     def load_metadata(self, pindex):
         if not self.__md_loaded:
             if not pindex:
-                self.load_metadata_from_mediafile()
-            elif (
-                self.get_mtime() < pindex.get_mtime()
-                and self.filename in pindex.data["medias"]
-            ):
+                if not self.__md_extracted:
+                    self.load_metadata_from_mediafile()
+            elif not self.__md_extracted and self.metadata_in_index(pindex):
                 # load metadata from persistent index
                 self.md = pindex.data["medias"][self.filename]
             else:
                 # load metadata from file
-                self.load_metadata_from_mediafile()
+                if not self.__md_extracted:
+                    self.load_metadata_from_mediafile()
                 pindex.load_media(self)
 
             assert self.md["date"].__class__ == datetime.datetime
@@ -198,6 +240,9 @@ class MediaFile(File):
 
 
 class ImageFile(MediaFile):
+
+    __slots__ = ()
+
     type = "image"
     mdloader = metadata.ImageInfoTags
 
@@ -244,6 +289,9 @@ class ImageFile(MediaFile):
 
 
 class VideoFile(MediaFile):
+
+    __slots__ = ()
+
     type = "video"
     mdloader = metadata.VideoInfoTags
 
@@ -326,6 +374,8 @@ class Directory(File):
 
         self.subdirs = subdirs
         self.filenames = filenames
+        self.__latest_media_stamps = {}
+        self.__all_medias_counts = {}
 
         self.human_name = self.album._str_humanize(self.name)
 
@@ -410,6 +460,49 @@ class Directory(File):
 
         return False
 
+    def extract_medias_metadata(self, pindex):
+        """
+        Reads the metadata of all the medias which are not up to date in
+        pindex, concurrently if the build runs with several jobs. The
+        results are merged into pindex by MediaFile.load_metadata().
+
+        If the album has a metadata cache, medias found there are not read
+        again, and the other ones are added to it. The medias removed from
+        the directory are removed from it.
+        """
+        to_extract = [m for m in self.medias if m.needs_metadata_extraction(pindex)]
+
+        mdcache = self.album.mdcache
+        removed = []
+        if mdcache is not None:
+            medias_names = set(self.medias_names)
+            if pindex is not None:
+                removed = [f for f in pindex.data["medias"] if f not in medias_names]
+
+        if mdcache is not None and (to_extract or removed):
+            cached = mdcache.load_dir(self.path)
+            removed = [f for f in cached if f not in medias_names]
+            missed = []
+            for media in to_extract:
+                md = mdcache.lookup(cached, media)
+                if md is None:
+                    missed.append(media)
+                else:
+                    media.set_extracted_metadata(md)
+            to_extract = missed
+
+        if len(to_extract) > 1:
+            logging.debug("Extracting metadata of %d medias", len(to_extract))
+            make.get_scheduler().map(MediaFile.extract_metadata, to_extract)
+        elif to_extract:
+            to_extract[0].extract_metadata()
+
+        if mdcache is not None and (to_extract or removed):
+            mdcache.store(self.path, to_extract, removed)
+
+    def get_subdir_count(self):
+        return len(self.subdirs)
+
     def get_media_count(self, media_type=None):
         if media_type is None:
             return len(self.medias_names)
@@ -421,25 +514,76 @@ class Directory(File):
             return typed_media_count
 
     def get_all_medias_count(self, media_type=None):
-        all_medias_count = self.get_media_count(media_type)
+        """
+        Returns the number of medias in this directory and below. Counts are
+        computed once, from the ones of the subdirectories.
+        """
+        if media_type not in self.__all_medias_counts:
+            all_medias_count = self.get_media_count(media_type)
+            for subdir in self.subdirs:
+                all_medias_count += subdir.get_all_medias_count(media_type)
+            self.__all_medias_counts[media_type] = all_medias_count
+        return self.__all_medias_counts[media_type]
+
+    def iter_all_medias(self):
+        """
+        Yields the medias of this directory, then the ones of each
+        subdirectory, recursively.
+        """
+        yield from self.medias
         for subdir in self.subdirs:
-            all_medias_count += subdir.get_all_medias_count(media_type)
-        return all_medias_count
+            yield from subdir.iter_all_medias()
 
     def get_all_medias(self):
-        all_medias = list(self.medias)  # We want a copy here.
-        for subdir in self.subdirs:
-            all_medias.extend(subdir.get_all_medias())
-        return all_medias
+        return list(self.iter_all_medias())
+
+    def iter_all_medias_paths(self):
+        return (m.path for m in self.iter_all_medias())
 
     def get_all_medias_paths(self):
-        return [m.path for m in self.get_all_medias()]
+        return list(self.iter_all_medias_paths())
 
-    def get_all_subdirs(self):
-        all_subdirs = list(self.subdirs)  # We want a copy here.
+    def iter_all_subdirs(self):
+        """
+        Yields the subdirectories, then the ones below each of them,
+        recursively.
+        """
+        yield from self.subdirs
         for subdir in self.subdirs:
-            all_subdirs.extend(subdir.get_all_subdirs())
-        return all_subdirs
+            yield from subdir.iter_all_subdirs()
+
+    def get_all_subdirs(self):
+        return list(self.iter_all_subdirs())
+
+    def latest_media_stamps(self, from_media=False):
+        """
+        Returns the latest reliable media date and the latest media mtime in
+        this directory and below, as timestamps or None. Those are computed
+        once for each value of from_media, from the ones of the
+        subdirectories.
+        """
+        if from_media not in self.__latest_media_stamps:
+            date_max = None
+            mtime_max = None
+            for m in self.medias:
+                m.load_metadata(not from_media)
+                if m.has_reliable_date():
+                    media_stamp = m.get_date_taken().timestamp()
+                    if date_max is None or media_stamp > date_max:
+                        date_max = media_stamp
+                media_stamp = m.get_datetime().timestamp()
+                if mtime_max is None or media_stamp > mtime_max:
+                    mtime_max = media_stamp
+
+            for subdir in self.subdirs:
+                date, mtime = subdir.latest_media_stamps(from_media)
+                if date is not None and (date_max is None or date > date_max):
+                    date_max = date
+                if mtime is not None and (mtime_max is None or mtime > mtime_max):
+                    mtime_max = mtime
+
+            self.__latest_media_stamps[from_media] = (date_max, mtime_max)
+        return self.__latest_media_stamps[from_media]
 
     def latest_media_stamp(self, from_media=False):
         """
@@ -447,23 +591,89 @@ class Directory(File):
             - first considering all pics that have a MD date
             - if none have a reliable date, use file mtimes.
         """
-        all_medias = self.get_all_medias()
-        media_stamp_max = None
-        for m in all_medias:
-            m.load_metadata(not from_media)
-            if m.has_reliable_date():
-                media_stamp = m.get_date_taken().timestamp()
-                if media_stamp_max is None or media_stamp > media_stamp_max:
-                    media_stamp_max = media_stamp
-
-        if media_stamp_max is None:
+        date_max, mtime_max = self.latest_media_stamps(from_media)
+        if date_max is None:
             # none of the media had a reliable date, use mtime instead
-            for m in all_medias:
-                media_stamp = m.get_datetime().timestamp()
-                if media_stamp_max is None or media_stamp > media_stamp_max:
-                    media_stamp_max = media_stamp
+            return mtime_max
+        return date_max
+
+
+class DirectorySummary(File):
+    """
+    What is kept of a Directory once its web gallery is generated in
+    streaming mode: what the directories above need from it. The medias are
+    only a sample to make album pictures from, and the subdirectories are
+    not kept. As a dependency, it stands for all the medias below it: its
+    mtime is the latest one of the directory and of those medias.
+    """
 
-        return media_stamp_max
+    SAMPLE_SIZE = eyecandy.PictureMess.THUMB_HOW_MANY
+
+    def __init__(self, directory, latest_stamps):
+        super().__init__(directory.path, directory.album)
+
+        self.name = directory.name
+        self.extension = None
+        self.human_name = directory.human_name
+        self.title = directory.title
+        self.desc = directory.desc
+        self.album_picture = directory.album_picture
+        self.metadata = directory.metadata
+
+        self.__subdir_count = directory.get_subdir_count()
+        self.__all_medias_counts = {
+            media_type: directory.get_all_medias_count(media_type)
+            for media_type in (None, "image", "video")
+        }
+        self.__latest_media_stamps = latest_stamps
+
+        # Keep the first media, which is the default album picture, and a
+        # random sample of the pictures for the album pictures above.
+        self.__medias = []
+        first_media = next(directory.iter_all_medias(), None)
+        if first_media is not None:
+            self.__medias.append(first_media)
+        images = [m for m in directory.iter_all_medias() if m.type == "image"]
+        if len(images) > self.SAMPLE_SIZE:
+            images = random.sample(images, self.SAMPLE_SIZE)
+        self.__medias.extend(m for m in images if m is not first_media)
+
+        self.stamp_build(self.latest_mtime(directory))
+
+    @classmethod
+    def latest_mtime(cls, directory):
+        """
+        Returns the latest mtime of directory and of the medias below it.
+        """
+        mtime = directory.get_mtime()
+        if isinstance(directory, cls):
+            return mtime
+        for media in directory.medias:
+            mtime = max(mtime, media.get_mtime())
+        for subdir in directory.subdirs:
+            mtime = max(mtime, cls.latest_mtime(subdir))
+        return mtime
+
+    def get_subdir_count(self):
+        return self.__subdir_count
+
+    def get_all_medias_count(self, media_type=None):
+        return self.__all_medias_counts[media_type]
+
+    def iter_all_medias(self):
+        return iter(self.__medias)
+
+    def iter_all_subdirs(self):
+        return iter(())
+
+    def latest_media_stamps(self, from_media=False):
+        return self.__latest_media_stamps
+
+    def latest_media_stamp(self, from_media=False):
+        date_max, mtime_max = self.__latest_media_stamps
+        if date_max is None:
+            return mtime_max
+        return date_max
 
 
 # vim: ts=4 sw=4 expandtab
@@ -16,32 +16,318 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import datetime
+import itertools
 import os
+import re
+import threading
 import time
 
-from genshi.core import START
+from genshi.core import START, END, TEXT, XML_DECL, DOCTYPE, START_NS, END_NS
+from genshi.core import START_CDATA, END_CDATA, PI, COMMENT, XML_NAMESPACE
+from genshi.core import Markup, escape
+from genshi.output import EMPTY, XHTMLSerializer
 from genshi.template import TemplateLoader, MarkupTemplate, NewTextTemplate
 from genshi.template import TemplateNotFound
 from genshi.template.eval import UndefinedError
 from genshi.input import XMLParser
 
 import lazygal
+from . import make
+
+
+class CompiledXHTMLRenderer(object):
+    """
+    Serializes the event stream of a template exactly like Genshi's 'xhtml'
+    render method, that is XHTMLSerializer and its empty tag, white space
+    and namespace filters, but in a single pass. The markup of tags is kept
+    from one page to the next, for each namespace context.
+
+    Pages may be rendered from several threads at once: the caches are only
+    modified with the lock held. Lookups are single dict operations, which
+    do not need it.
+    """
+
+    EMPTY_ELEMS = XHTMLSerializer._EMPTY_ELEMS
+    BOOLEAN_ATTRS = XHTMLSerializer._BOOLEAN_ATTRS
+    PRESERVE_SPACE = XHTMLSerializer._PRESERVE_SPACE
+    XML_SPACE = XML_NAMESPACE["space"]
+    XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+
+    # Pages share most of their tags, but not those with per page attributes.
+    MAX_CACHED_TAGS = 10000
+
+    trim_trailing_space = re.compile("[ \t]+(?=\n)").sub
+    collapse_lines = re.compile("\n{2,}").sub
+
+    def __init__(self):
+        self.caches = {}
+        self.lock = threading.Lock()
+
+    def get_cache(self, namespaces):
+        key = tuple(sorted((uri, tuple(p)) for uri, p in namespaces.items()))
+        cache = self.caches.get(key)
+        if cache is None:
+            with self.lock:
+                cache = self.caches.setdefault(key, {})
+        return cache
+
+    def cache_markup(self, cache, key, markup):
+        with self.lock:
+            if len(cache) > self.MAX_CACHED_TAGS:
+                cache.clear()
+            cache[key] = markup
+
+    @staticmethod
+    def empty_tags(stream):
+        pending_start = None
+        for kind, data, pos in stream:
+            if pending_start is not None:
+                if kind is END:
+                    yield EMPTY, pending_start
+                    pending_start = None
+                    continue
+                yield START, pending_start
+                pending_start = None
+            if kind is START:
+                pending_start = data
+            else:
+                yield kind, data
+
+    def render(self, stream):
+        """
+        Returns the UTF-8 encoded XHTML serialization of stream.
+        """
+        out = []
+        emit = out.append
+
+        textbuf = []
+        preserve = 0
+        noescape = False
+        have_doctype = False
+
+        namespaces = {XML_NAMESPACE.uri: ["xml"]}
+        prefixes = {"xml": [XML_NAMESPACE.uri], "": [self.XHTML_NAMESPACE]}
+        ns_attrs = []
+        new_prefixes = ("ns%d" % i for i in itertools.count(1))
+        cache = self.get_cache(namespaces)
+        # Like Genshi, tags serialized with namespace declarations are reused
+        # until the namespace context changes.
+        quirks = {}
+
+        def push_ns(prefix, uri):
+            namespaces.setdefault(uri, []).append(prefix)
+            prefixes.setdefault(prefix, []).append(uri)
+
+        def pop_ns(prefix):
+            uris = prefixes.get(prefix)
+            uri = uris.pop()
+            if not uris:
+                del prefixes[prefix]
+            if uri not in uris or uri != uris[-1]:
+                uri_prefixes = namespaces[uri]
+                uri_prefixes.pop()
+                if not uri_prefixes:
+                    del namespaces[uri]
+            return uri
+
+        def make_ns_attr(prefix, uri):
+            return "xmlns%s" % (prefix and ":%s" % prefix or ""), uri
+
+        events = itertools.chain(self.empty_tags(stream), [(None, None)])
+        for kind, data in events:
+            if kind is TEXT:
+                if noescape:
+                    data = Markup(data)
+                textbuf.append(data)
+                continue
+
+            if textbuf:
+                if len(textbuf) > 1:
+                    text = Markup("").join(textbuf, escape_quotes=False)
+                    del textbuf[:]
+                else:
+                    text = escape(textbuf.pop(), quotes=False)
+                if not preserve:
+                    text = self.collapse_lines("\n", self.trim_trailing_space("", text))
+                emit(text)
+
+            if kind is START or kind is EMPTY:
+                tag, attrs = data
+                if kind is START and (
+                    preserve
+                    or tag in self.PRESERVE_SPACE
+                    or attrs.get(self.XML_SPACE) == "preserve"
+                ):
+                    preserve += 1
+
+                markup = None
+                if not ns_attrs:
+                    markup = quirks.get((kind, data)) or cache.get((kind, data))
+                if markup is None:
+                    pushed = False
+                    tagname = tag.localname
+                    tagns = tag.namespace
+                    if tagns:
+                        if tagns in namespaces:
+                            prefix = namespaces[tagns][-1]
+                            if prefix:
+                                tagname = "%s:%s" % (prefix, tagname)
+                        else:
+                            ns_attrs.append(("xmlns", tagns))
+                            push_ns("", tagns)
+                            pushed = True
+
+                    flat_attrs = list(ns_attrs)
+                    for attr, value in attrs:
+                        attrname = attr.localname
+                        attrns = attr.namespace
+                        if attrns:
+                            if attrns not in namespaces:
+                                prefix = next(new_prefixes)
+                                push_ns(prefix, attrns)
+                                ns_attrs.append(("xmlns:%s" % prefix, attrns))
+                                flat_attrs.insert(len(ns_attrs) - 1, ns_attrs[-1])
+                                pushed = True
+                            else:
+                                prefix = namespaces[attrns][-1]
+                            if prefix:
+                                attrname = "%s:%s" % (prefix, attrname)
+                        flat_attrs.append((attrname, value))
+
+                    buf = ["<", tagname]
+                    for attr, value in flat_attrs:
+                        if attr in self.BOOLEAN_ATTRS:
+                            value = attr
+                        elif attr == "xml:lang" and "lang" not in [
+                            a for a, v in flat_attrs
+                        ]:
+                            buf += [' lang="', escape(value), '"']
+                        elif attr == "xml:space":
+                            continue
+                        buf += [" ", attr, '="', escape(value), '"']
+                    if kind is EMPTY:
+                        if tagname in self.EMPTY_ELEMS:
+                            buf.append(" />")
+                        else:
+                            buf.append("></%s>" % tagname)
+                    else:
+                        buf.append(">")
+                    markup = "".join(buf)
+
+                    if pushed:
+                        cache = self.get_cache(namespaces)
+                        quirks = {}
+                    if ns_attrs:
+                        quirks[kind, data] = markup
+                        del ns_attrs[:]
+                    else:
+                        self.cache_markup(cache, (kind, data), markup)
+                emit(markup)
+
+            elif kind is END:
+                noescape = False
+                if preserve:
+                    preserve -= 1
+
+                markup = cache.get((kind, data))
+                if markup is None:
+                    tagname = data.localname
+                    tagns = data.namespace
+                    if tagns:
+                        prefix = namespaces[tagns][-1]
+                        if prefix:
+                            tagname = "%s:%s" % (prefix, tagname)
+                    markup = "</%s>" % tagname
+                    self.cache_markup(cache, (kind, data), markup)
+                emit(markup)
+
+            elif kind is START_NS:
+                prefix, uri = data
+                if uri not in namespaces:
+                    prefix = prefixes.get(uri, [prefix])[-1]
+                    ns_attrs.append(make_ns_attr(prefix, uri))
+                push_ns(prefix, uri)
+                cache = self.get_cache(namespaces)
+                quirks = {}
+
+            elif kind is END_NS:
+                if data in prefixes:
+                    uri = pop_ns(data)
+                    cache = self.get_cache(namespaces)
+                    quirks = {}
+                    if ns_attrs:
+                        attr = make_ns_attr(data, uri)
+                        if attr in ns_attrs:
+                            ns_attrs.remove(attr)
+
+            elif kind is COMMENT:
+                emit("<!--%s-->" % data)
+
+            elif kind is DOCTYPE and not have_doctype:
+                name, pubid, sysid = data
+                buf = ["<!DOCTYPE %s"]
+                if pubid:
+                    buf.append(' PUBLIC "%s"')
+                elif sysid:
+                    buf.append(" SYSTEM")
+                if sysid:
+                    buf.append(' "%s"')
+                buf.append(">\n")
+                emit(Markup("".join(buf)) % tuple([p for p in data if p]))
+                have_doctype = True
+
+            elif kind is START_CDATA:
+                noescape = True
+                emit("<![CDATA[")
+
+            elif kind is END_CDATA:
+                noescape = False
+                emit("]]>")
+
+            elif kind is PI:
+                emit("<?%s %s?>" % data)
+
+        return "".join(out).encode("utf-8", "xmlcharrefreplace")
 
 
 class LazygalTemplate(object):
-
     def __init__(self, loader, genshi_tpl):
         self.loader = loader
         self.path = genshi_tpl.filepath
         self.genshi_tpl = genshi_tpl
+        self.__file_dependency = None
+        self.__dependencies = None
+
+    def subtemplates(self):
+        return []
+
+    def dependencies(self):
+        """
+        Returns the file dependencies of this template and of all the
+        templates it includes. Those are computed once, and shared by all
+        the pages using this template.
+        """
+        if self.__dependencies is None:
+            self.__dependencies = [self.file_dependency()]
+            for subtpl in self.subtemplates():
+                self.__dependencies.append(subtpl.file_dependency())
+        return self.__dependencies
+
+    def file_dependency(self):
+        if self.__file_dependency is None:
+            self.__file_dependency = make.FileSimpleDependency(self.path)
+        return self.__file_dependency
+
+    def __complement_values(self, values, generated=None):
+        if generated is not None:
+            values["gen_datetime"], values["gen_date"] = generated
+        else:
+            values["gen_datetime"] = datetime.datetime.now()
 
-    def __complement_values(self, values):
-        values["gen_datetime"] = datetime.datetime.now()
-
-        # using time.strftime() here instead of datetime.strftime() because
-        # the latter does not carry the current timezone info, and '%c' in some
-        # locales needs to display tzname.
-        values["gen_date"] = time.strftime("%c")
+            # using time.strftime() here instead of datetime.strftime() because
+            # the latter does not carry the current timezone info, and '%c' in
+            # some locales needs to display tzname.
+            values["gen_date"] = time.strftime("%c")
 
         values["lazygal_version"] = lazygal.__version__
 
@@ -60,19 +346,44 @@ class LazygalTemplate(object):
         # string. This is because we are not out of lazygal yet.
         return self.__generate(values).render(self.serialization_method, encoding=None)
 
+    def get_renderer(self):
+        return None
+
+    def render(self, values, generated=None):
+        """
+        Returns the UTF-8 encoded output of the template. If generated is
+        given, this is the (gen_datetime, gen_date) pair of a previous
+        rendering, used instead of the current date.
+        """
+        self.__complement_values(values, generated)
+
+        renderer = self.get_renderer()
+        try:
+            if renderer is not None:
+                return renderer.render(self.__generate(values))
+            else:
+                return self.__generate(values).render(
+                    method=self.serialization_method, encoding="utf-8"
+                )
+        except UndefinedError as e:
+            print("W: %s" % e)
+            raise
+
     def dump(self, values, dest):
         self.__complement_values(values)
 
-        page = open(dest, "wb")
+        renderer = self.get_renderer()
         try:
-            self.__generate(values).render(
-                method=self.serialization_method, out=page, encoding="utf-8"
-            )
+            with make.atomic_open(dest, "wb") as page:
+                if renderer is not None:
+                    page.write(renderer.render(self.__generate(values)))
+                else:
+                    self.__generate(values).render(
+                        method=self.serialization_method, out=page, encoding="utf-8"
+                    )
         except UndefinedError as e:
             print("W: %s" % e)
             raise
-        finally:
-            page.close()
 
 
 class XmlTemplate(LazygalTemplate):
@@ -80,14 +391,26 @@ class XmlTemplate(LazygalTemplate):
     serialization_method = "xhtml"
     genshi_tpl_class = MarkupTemplate
 
-    def subtemplates(self, tpl=None):
-        if tpl is None:
-            tpl = self
-
+    def __init__(self, loader, genshi_tpl):
+        super().__init__(loader, genshi_tpl)
+        self.__subtemplates = None
+        self.__renderer = None
+
+    def get_renderer(self):
+        if not self.loader.compiled:
+            return None
+        if self.__renderer is None:
+            self.__renderer = CompiledXHTMLRenderer()
+        return self.__renderer
+
+    def includes(self):
+        """
+        Returns the templates directly included by this template.
+        """
         subtemplates = []
-        f = open(tpl.path, "r")
+        f = open(self.path, "r")
         try:
-            for kind, data, pos in XMLParser(f, filename=tpl.path):
+            for kind, data, pos in XMLParser(f, filename=self.path):
                 if kind is START:
                     tag, attrib = data
                     if (
@@ -105,14 +428,22 @@ class XmlTemplate(LazygalTemplate):
                             subtemplates.append(subtpl)
         finally:
             f.close()
-
-        for subtemplate in subtemplates:
-            for new_subtpl in self.subtemplates(subtemplate):
-                if new_subtpl not in subtemplates:
-                    subtemplates.append(new_subtpl)
-
         return subtemplates
 
+    def subtemplates(self):
+        """
+        Returns all the templates included by this template, recursively.
+        The template file is only parsed once.
+        """
+        if self.__subtemplates is None:
+            subtemplates = self.includes()
+            for subtemplate in list(subtemplates):
+                for new_subtpl in subtemplate.subtemplates():
+                    if new_subtpl not in subtemplates:
+                        subtemplates.append(new_subtpl)
+            self.__subtemplates = subtemplates
+        return self.__subtemplates
+
 
 class PlainTemplate(LazygalTemplate):
 
@@ -128,24 +459,39 @@ class TplFactory(object):
         ".tjs": PlainTemplate,
     }
 
+    # Whether XHTML pages are serialized with CompiledXHTMLRenderer
+    compiled = False
+
     def __init__(self, default_tpl_dir, tpl_dir):
+        self.search_path = [tpl_dir, default_tpl_dir]
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets about the loaded templates, so that they are loaded again
+        from their files.
+        """
         # We use lenient mode here because we want an easy way to check whether
         # a template variable is defined, or the empty string, thus defined()
         # will only work for the 'whether it is defined' part of the test.
-        self.loader = TemplateLoader(
-            [tpl_dir, default_tpl_dir], variable_lookup="lenient"
-        )
+        self.loader = TemplateLoader(self.search_path, variable_lookup="lenient")
+        # Templates are shared by all the pages, indexed by template ident.
+        self.templates = {}
 
     def is_known_template_type(self, file):
         filename, ext = os.path.splitext(os.path.basename(file))
         return ext in self.known_exts.keys()
 
     def load(self, tpl_ident):
+        if tpl_ident in self.templates:
+            return self.templates[tpl_ident]
+
         if self.is_known_template_type(tpl_ident):
             filename, ext = os.path.splitext(os.path.basename(tpl_ident))
             tpl_class = self.known_exts[ext]
             tpl = self.loader.load(tpl_ident, cls=tpl_class.genshi_tpl_class)
-            return tpl_class(self, tpl)
+            self.templates[tpl_ident] = tpl_class(self, tpl)
+            return self.templates[tpl_ident]
         else:
             raise ValueError(_("Unknown template type for %s" % tpl_ident))
 
@@ -219,7 +219,7 @@ class Webgal(SrcPath):
         if "album_name" not in dir_info:
             dir_info["album_name"] = self.webgal.source_dir.human_name
 
-        dirzip = self.webgal.webassets.data["dirzip"]
+        dirzip = self.webgal.get_dirzip_info()
         if dirzip:
             archive_rel_dir = self.webgal.rel_path(self.page.dir.path)
             archive_rel_path = posixpath.join(archive_rel_dir, dirzip["filename"])
@@ -229,7 +229,7 @@ class Webgal(SrcPath):
         dir_info["is_main"] = self.webgal is self.page.dir
 
         dir_info["image_count"] = self.webgal.pindex.get_media_count("image")
-        dir_info["subgal_count"] = len(self.webgal.source_dir.subdirs)
+        dir_info["subgal_count"] = self.webgal.source_dir.get_subdir_count()
 
         dir_info["id"] = pathutils.url_quote(self.id())
 
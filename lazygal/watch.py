@@ -0,0 +1,191 @@
+# Lazygal, a lazy static web gallery generator.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+# Changes are only reported once the source tree has been quiet for that
+# long, so that an upload of many files triggers a single generation.
+SETTLE_DELAY = 1
+POLL_INTERVAL = 2
+
+
+class PollingWatcher(object):
+    """
+    Detects source tree changes by comparing the mtimes of its directories
+    and files at regular intervals.
+    """
+
+    def __init__(self, album):
+        self.album = album
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for root, dirnames, filenames in self.album.scan_journal.walk(
+            self.album.source_dir
+        ):
+            paths = [(root, True)]
+            paths.extend((os.path.join(root, f), False) for f in filenames)
+            for path, is_dir in paths:
+                try:
+                    snapshot[path] = (os.stat(path).st_mtime_ns, is_dir)
+                except OSError:
+                    pass  # removed in the meantime
+        return snapshot
+
+    def changed_dirs(self, snapshot):
+        changed = set()
+        for path in set(snapshot.keys()) | set(self.snapshot.keys()):
+            new, old = snapshot.get(path), self.snapshot.get(path)
+            if new != old:
+                mtime_ns, is_dir = new or old
+                changed.add(is_dir and path or os.path.dirname(path))
+        return changed
+
+    def wait(self):
+        """
+        Blocks until the source tree changes, and returns the set of the
+        directories which contents changed.
+        """
+        changed = set()
+        while True:
+            time.sleep(changed and SETTLE_DELAY or POLL_INTERVAL)
+            snapshot = self.take_snapshot()
+            new_changes = self.changed_dirs(snapshot)
+            self.snapshot = snapshot
+            if new_changes:
+                changed.update(new_changes)
+            elif changed:
+                return changed
+
+
+class InotifyWatcher(object):
+    """
+    Detects source tree changes using the Linux inotify API.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    )
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, album):
+        self.album = album
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            self.__raise_errno()
+
+        self.watched = {}
+        self.add_watches()
+
+    def __raise_errno(self):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def add_watches(self):
+        """
+        Watches all the directories of the source tree. Adding a watch
+        twice on the same directory is harmless.
+        """
+        for root, dirnames, filenames in self.album.scan_journal.walk(
+            self.album.source_dir
+        ):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.MASK)
+            if wd < 0:
+                self.__raise_errno()
+            self.watched[wd] = root
+
+    def read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset = offset + self.EVENT_HEADER.size
+            name = data[offset : offset + name_len].rstrip(b"\0")
+            offset = offset + name_len
+            yield wd, mask, os.fsdecode(name)
+
+    def wait(self):
+        """
+        Blocks until the source tree changes, and returns the set of the
+        directories which contents changed.
+        """
+        changed = set()
+        timeout = None
+        while True:
+            ready, w, x = select.select([self.fd], [], [], timeout)
+            if not ready:
+                break  # quiet for long enough
+
+            for wd, mask, name in self.read_events():
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were lost, check the whole album.
+                    logging.info(_("Too many changes at once, checking all."))
+                    changed.add(self.album.source_dir)
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.watched.pop(wd, None)
+                    continue
+                root = self.watched.get(wd)
+                if root is None:
+                    continue
+                changed.add(root)
+                if mask & self.IN_ISDIR:
+                    changed.add(os.path.join(root, name))
+            timeout = SETTLE_DELAY
+
+        # Watch new directories, including those which creation was lost
+        try:
+            self.add_watches()
+        except OSError as e:
+            logging.warning(_("Cannot watch new directories: %s"), e)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(album):
+    try:
+        return InotifyWatcher(album)
+    except (OSError, AttributeError) as e:
+        logging.info(_("Cannot use inotify (%s), polling for changes."), e)
+        return PollingWatcher(album)
+
+
+# vim: ts=4 sw=4 expandtab
@@ -301,6 +301,59 @@ class TestConf(LazygalTestGen):
         )
         self.assertRaises(ValueError, config.set, "webgal", "image-size", "crappy")
         self.assertRaises(ValueError, config.set, "runtime", "quiet", "foo")
+        self.assertRaises(ValueError, config.set, "webgal", "original-link", "symlink")
+
+        # invalid values of configuration files are ignored
+        with self.assertLogs(level="WARNING"):
+            config.load({"webgal": {"original-link": "symlink"}})
+        self.assertNotIn("original-link", config.options("webgal"))
+
+    def test_perdir_conf_read_once(self):
+        """
+        During a generation, each configuration file shall only be read
+        once, and identical sizes shall be shared between galleries.
+        """
+        for subgal in ("sub1", "sub2"):
+            os.makedirs(os.path.join(self.source_dir, "gal", subgal))
+        with open(os.path.join(self.source_dir, "gal", ".lazygal"), "w") as f:
+            json.dump({"template-vars": {"foo": "gal"}}, f)
+        self.setup_album()
+        self.setup_subgal(os.path.join("gal", "sub1"), ["sub1_img.jpg"])
+        self.setup_subgal(os.path.join("gal", "sub2"), ["sub2_img.jpg"])
+
+        read_paths = []
+        load_file = lazygal.config.LazygalConfig.load_file
+
+        def counting_load_file(config, path):
+            read_paths.append(path)
+            return load_file(config, path)
+
+        lazygal.config.LazygalConfig.load_file = counting_load_file
+        try:
+            self.album.generate(self.get_working_path())
+        finally:
+            lazygal.config.LazygalConfig.load_file = load_file
+
+        self.assertEqual(
+            sorted(read_paths),
+            [
+                lazygal.config.DEFAULT_CONFIG_PATH,
+                os.path.join(self.source_dir, "gal", ".lazygal"),
+            ],
+        )
+
+        dest_path = self.get_working_path()
+        sub1, sub2 = (
+            WebalbumDir(
+                Directory(os.path.join(self.source_dir, "gal", s), [], [], self.album),
+                [],
+                self.album,
+                dest_path,
+            )
+            for s in ("sub1", "sub2")
+        )
+        self.assertEqual(sub1.config.get("template-vars", "foo"), "gal")
+        self.assertIs(sub1.newsizers["thumb"], sub2.newsizers["thumb"])
 
 
 if __name__ == "__main__":
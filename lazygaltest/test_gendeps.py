@@ -21,6 +21,8 @@ import time
 import unittest
 
 from . import LazygalTestGen
+import lazygal.config
+from lazygal import make
 from lazygal.generators import WebalbumDir
 from lazygal.sourcetree import Directory
 from lazygal.genpage import WebalbumIndexPage
@@ -146,6 +148,253 @@ class TestDeps(LazygalTestGen):
             "Webalbum gal index should need build because of added pic in subgal.",
         )
 
+    def test_checksum_touched_source(self):
+        """
+        In checksum mode, a source image which only got a newer mtime shall
+        not trigger the generation of its resized versions.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "checksum", True)
+        self.setup_album(config)
+
+        img_path = self.add_img(self.source_dir, "img.jpg")
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        self.assertTrue(os.path.isfile(os.path.join(dest_path, "build.json")))
+        thumb_path = os.path.join(dest_path, "img_thumb.jpg")
+        thumb_mtime = os.path.getmtime(thumb_path)
+
+        newer = thumb_mtime + 60
+        os.utime(img_path, (newer, newer))
+        self.album.generate(dest_path)
+
+        self.assertEqual(os.path.getmtime(thumb_path), thumb_mtime)
+
+        # Modified contents shall still be detected.
+        with open(img_path, "ab") as img_fp:
+            img_fp.write(b"\0")
+        newer = newer + 60
+        os.utime(img_path, (newer, newer))
+        self.album.generate(dest_path)
+
+        self.assertNotEqual(os.path.getmtime(thumb_path), thumb_mtime)
+
+    def test_checksum_enabled_later(self):
+        """
+        Outputs built before checksum mode was enabled shall not be built
+        again when their source only gets a newer mtime.
+        """
+        img_path = self.add_img(self.source_dir, "img.jpg")
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        self.album.config.set("runtime", "checksum", True)
+        self.album.generate(dest_path)
+
+        thumb_path = os.path.join(dest_path, "img_thumb.jpg")
+        thumb_mtime = os.path.getmtime(thumb_path)
+        newer = thumb_mtime + 60
+        os.utime(img_path, (newer, newer))
+        self.album.generate(dest_path)
+
+        self.assertEqual(os.path.getmtime(thumb_path), thumb_mtime)
+
+    def test_recipe_change(self):
+        """
+        A configuration change shall only trigger the generation of the
+        resized pictures which generation parameters changed.
+        """
+        img_path = self.add_img(self.source_dir, "img.jpg")
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        thumb_path = os.path.join(dest_path, "img_thumb.jpg")
+        small_path = os.path.join(dest_path, "img_small.jpg")
+        past = time.time() - 60
+        os.utime(img_path, (past - 60, past - 60))
+        for path in (thumb_path, small_path):
+            os.utime(path, (past, past))
+
+        self.album.generate(dest_path)
+        self.assertEqual(os.path.getmtime(thumb_path), past)
+        self.assertEqual(os.path.getmtime(small_path), past)
+
+        self.album.config.set("webgal", "thumbnail-size", "100x100")
+        self.album.generate(dest_path)
+        self.assertNotEqual(os.path.getmtime(thumb_path), past)
+        self.assertEqual(os.path.getmtime(small_path), past)
+
+    def test_media_option_change(self):
+        """
+        A change of an option only used to generate the medias shall not
+        trigger the generation of the directory index.
+        """
+        img_path = self.add_img(self.source_dir, "img.jpg")
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        pindex_path = os.path.join(dest_path, "index.json")
+        thumb_path = os.path.join(dest_path, "img_thumb.jpg")
+        past = time.time() - 60
+        for path in (img_path, self.source_dir):
+            os.utime(path, (past - 60, past - 60))
+        for path in (pindex_path, thumb_path):
+            os.utime(path, (past, past))
+
+        self.album.config.set("webgal", "jpeg-quality", 50)
+        self.album.generate(dest_path)
+        self.assertEqual(os.path.getmtime(pindex_path), past)
+        self.assertNotEqual(os.path.getmtime(thumb_path), past)
+
+        os.utime(thumb_path, (past, past))
+        self.album.generate(dest_path)
+        self.assertEqual(os.path.getmtime(thumb_path), past)
+
+    def test_changed_dirs(self):
+        """
+        When the changed directories are known, the other ones shall not be
+        checked.
+        """
+        source_subgal = self.setup_subgal("subgal", ["subgal_img.jpg"])
+        self.setup_subgal("other", ["other_img.jpg"])
+
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        other_thumb = os.path.join(dest_path, "other", "other_img_thumb.jpg")
+        os.unlink(other_thumb)
+
+        self.add_img(source_subgal.path, "subgal_img2.jpg")
+        self.album.generate(dest_path, changed_dirs={source_subgal.path})
+        new_thumb = os.path.join(dest_path, "subgal", "subgal_img2_thumb.jpg")
+        self.assertTrue(os.path.isfile(new_thumb))
+        self.assertFalse(os.path.isfile(other_thumb))
+
+        self.album.config.set("runtime", "check-all-dirs", True)
+        self.album.generate(dest_path)
+        self.assertTrue(os.path.isfile(other_thumb))
+
+    def test_atomic_output(self):
+        """
+        An output is either completely written or left as it was.
+        """
+        src_path = os.path.join(self.tmpdir, "src.txt")
+        dest_path = os.path.join(self.tmpdir, "dest.txt")
+        tmp_path = os.path.join(self.tmpdir, "dest.tmp.txt")
+        self.create_file(src_path, "source")
+        self.create_file(dest_path, "previous")
+
+        with self.assertRaises(RuntimeError):
+            with make.atomic_open(dest_path, "w") as dest_fp:
+                dest_fp.write("trunc")
+                raise RuntimeError("killed")
+        with open(dest_path) as dest_fp:
+            self.assertEqual(dest_fp.read(), "previous")
+        self.assertFalse(os.path.exists(tmp_path))
+
+        # A temporary file left over is not written to.
+        os.link(src_path, tmp_path)
+        make.FileCopy(src_path, dest_path).build()
+        for path in (src_path, dest_path):
+            with open(path) as fp:
+                self.assertEqual(fp.read(), "source")
+        self.assertFalse(os.path.exists(tmp_path))
+
+    def test_cleanup_spares_written_outputs(self):
+        """
+        An output being written, e.g. in the background, is not a foreign
+        file of its directory.
+        """
+        source_subgal = self.setup_subgal("subgal", ["subgal_img.jpg"])
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        webgal = WebalbumDir(source_subgal, [], self.album, dest_path)
+        video_path = os.path.join(dest_path, "subgal", "vid_video.webm")
+        with make.atomic_path(video_path) as tmp_path:
+            self.create_file(tmp_path, "transcoding")
+            self.assertEqual(webgal.list_foreign_files(), [])
+        self.assertEqual(webgal.list_foreign_files(), [video_path])
+
+    def test_compact_tasks(self):
+        """
+        Source files are not outputs of the tasks depending on them, and
+        media records do not carry a __dict__.
+        """
+        source_subgal = self.setup_subgal(
+            "subgal", ["subgal_img.jpg", "subgal_img2.jpg"]
+        )
+        dest_path = os.path.join(self.tmpdir, "dst")
+        self.album.generate(dest_path)
+
+        webgal = WebalbumDir(source_subgal, [], self.album, dest_path)
+        webgal.call_populate_deps()
+        source_paths = [m.path for m in source_subgal.medias]
+        for task in webgal.deps:
+            for path in source_paths:
+                self.assertNotIn(path, task.output_items)
+        for media in source_subgal.medias:
+            self.assertFalse(hasattr(media, "__dict__"))
+
+        subgal_dest = os.path.join(dest_path, "subgal")
+        self.assertEqual(webgal.list_foreign_files(), [])
+        self.create_file(os.path.join(subgal_dest, "junk.html"), "junk")
+        self.assertEqual(
+            webgal.list_foreign_files(), [os.path.join(subgal_dest, "junk.html")]
+        )
+
+    def test_inline_build_waits_deps(self):
+        """
+        A parallel task built in the calling thread shall be built after its
+        dependencies running on another pool.
+        """
+        built = []
+
+        class Slow(make.MakeTask):
+            parallel = True
+            queue = "video"
+
+            def build(self):
+                time.sleep(0.1)
+                built.append(self)
+
+        class Inline(make.MakeTask):
+            parallel = True
+
+            def build(self):
+                built.append(self)
+
+        slow = Slow()
+        inline = Inline()
+        inline.add_dependency(slow)
+        with make.Scheduler(1, 2) as scheduler:
+            self.assertFalse(scheduler.in_background(slow))
+            inline.make()
+            self.assertEqual(built, [slow, inline])
+
+    def test_profile_self_time(self):
+        """
+        The profile shall not account the build of a task made from within
+        the build of another one twice.
+        """
+
+        class Sleeper(make.MakeTask):
+            def build(self):
+                time.sleep(0.1)
+
+        class Outer(make.MakeTask):
+            def build(self):
+                Sleeper().make()
+
+        profile = make.BuildProfile()
+        with make.Scheduler(1, profile=profile):
+            Outer().make()
+        report = profile.report()
+        self.assertEqual(report["phases"]["build"]["count"], 2)
+        self.assertLess(report["phases"]["build"]["wall"], 0.15)
+        self.assertLess(report["classes"]["Outer"]["build"]["wall"], 0.05)
+
 
 if __name__ == "__main__":
     unittest.main()
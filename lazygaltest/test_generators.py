@@ -21,15 +21,20 @@ import os
 import datetime
 import shutil
 import json
+import sqlite3
+import threading
+import time
+import zipfile
 
 from PIL import Image
 
 from . import LazygalTestGen, has_symlinks
 import lazygal.config
+from lazygal import genmedia
 from lazygal.generators import WebalbumDir
 from lazygal.sourcetree import Directory
 from lazygal.metadata import GEXIV2_DATE_FORMAT, GExiv2
-from lazygal.mediautils import VideoProcessor, HAVE_VIDEO
+from lazygal.mediautils import VideoProcessor, VideoThumbnailer, HAVE_VIDEO
 
 
 class TestGenerators(LazygalTestGen):
@@ -422,6 +427,38 @@ class TestGenerators(LazygalTestGen):
         # Test if that symlink point to the image in the source_dir
         self.assertEqual(os.path.realpath(symlink), img_path)
 
+    def test_originals_links(self):
+        config = lazygal.config.LazygalConfig()
+        config.set("webgal", "original", "Yes")
+        config.set("webgal", "original-link", "hardlink")
+        self.setup_album(config)
+
+        img_path = self.add_img(self.source_dir, "img.jpg")
+
+        dest_dir = self.get_working_path()
+        self.album.generate(dest_dir)
+
+        original = os.path.join(dest_dir, "img.jpg")
+        self.assertTrue(os.path.samefile(original, img_path))
+
+        # A hard link is not older than its source.
+        dest_gal = WebalbumDir(
+            Directory(self.source_dir, [], ["img.jpg"], self.album),
+            [],
+            self.album,
+            dest_dir,
+        )
+        self.assertFalse(dest_gal.needs_build())
+
+        # Reflinks fall back to a copy where unsupported.
+        self.album.config.set("webgal", "original-link", "reflink")
+        dest_dir = self.get_working_path()
+        self.album.generate(dest_dir)
+        original = os.path.join(dest_dir, "img.jpg")
+        self.assertFalse(os.path.samefile(original, img_path))
+        with open(original, "rb") as orig_fp, open(img_path, "rb") as img_fp:
+            self.assertEqual(orig_fp.read(), img_fp.read())
+
     def test_metadata_osize_copy(self):
         img_path = self.add_img(self.source_dir, "md_filled.jpg")
 
@@ -541,6 +578,25 @@ class TestGenerators(LazygalTestGen):
         )
         im.close()
 
+    def test_thumbnail_resample_fast(self):
+        config = lazygal.config.LazygalConfig()
+        config.set("webgal", "thumbnail-resample", "fast")
+        self.setup_album(config)
+
+        self.add_img(self.source_dir, "img.jpg")
+
+        dest_dir = self.get_working_path()
+        self.album.generate(dest_dir)
+
+        im = Image.open(os.path.join(dest_dir, "img_thumb.jpg"))
+        self.assertEqual(im.size, (150, 100))
+        im.close()
+
+        # Other sizes are not affected.
+        im = Image.open(os.path.join(dest_dir, "img_small.jpg"))
+        self.assertEqual(im.size, (800, 533))
+        im.close()
+
     def test_sizeasoriginal(self):
         config = lazygal.config.LazygalConfig()
         config.set("webgal", "original", True)
@@ -597,11 +653,118 @@ class TestGenerators(LazygalTestGen):
         self.setup_album(config)
 
         img_path = self.add_img(self.source_dir, "img01.jpg")
-        img_path = self.add_img(self.source_dir, "img02.jpg")
+        self.add_img(self.source_dir, "img02.jpg")
+        dest_dir = self.get_working_path()
+        self.album.generate(dest_dir)
+
+        zip_path = os.path.join(dest_dir, "src.zip")
+        self.assertTrue(os.path.isfile(zip_path))
+
+        # Added pictures are appended.
+        time.sleep(1)
+        self.add_img(self.source_dir, "img03.jpg")
+        with self.assertLogs(level="DEBUG") as logs:
+            self.album.generate(dest_dir)
+        self.assertIn("(appending 1 pictures)", "\n".join(logs.output))
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                ["src/img01.jpg", "src/img02.jpg", "src/img03.jpg"],
+            )
+            for info in archive.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+        # Changed pictures are written again, the others are copied.
+        time.sleep(1)
+        changed_path = os.path.join(self.source_dir, "img02.jpg")
+        with open(changed_path, "ab") as img_fp:
+            img_fp.write(b"\0")
+        with self.assertLogs(level="DEBUG") as logs:
+            self.album.generate(dest_dir)
+        self.assertIn("(writing 1 pictures, copying 2)", "\n".join(logs.output))
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertEqual(
+                archive.namelist(), ["src/img01.jpg", "src/img02.jpg", "src/img03.jpg"]
+            )
+            for info in archive.infolist():
+                src_path = os.path.join(
+                    self.source_dir, os.path.basename(info.filename)
+                )
+                with open(src_path, "rb") as src_fp:
+                    self.assertEqual(archive.read(info), src_fp.read())
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+        # Removed pictures are left out.
+        os.unlink(img_path)
+        with self.assertLogs(level="DEBUG") as logs:
+            self.album.generate(dest_dir)
+        self.assertNotIn("(appending", "\n".join(logs.output))
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()), ["src/img02.jpg", "src/img03.jpg"]
+            )
+
+    def test_unchanged_pages(self):
+        config = lazygal.config.LazygalConfig()
+        config.set("global", "ignore-gen-date", "Yes")
+        self.setup_album(config)
+
+        self.add_img(self.source_dir, "img01.jpg")
+        dest_dir = self.get_working_path()
+        self.album.generate(dest_dir)
+
+        page_paths = [os.path.join(dest_dir, fn) for fn in ("index.html", "img01.html")]
+        page_stats = [os.stat(path) for path in page_paths]
+
+        def read_build_index():
+            with open(os.path.join(dest_dir, "build.json")) as build_fp:
+                return json.load(build_fp)["pages"]
+
+        # Pages which only differ by their generation date are not written.
+        time.sleep(1)
+        os.utime(self.source_dir)
+        self.album.generate(dest_dir)
+        for path, page_stat in zip(page_paths, page_stats):
+            self.assertEqual(os.stat(path).st_ino, page_stat.st_ino)
+            self.assertEqual(os.stat(path).st_mtime, page_stat.st_mtime)
+
+        # Nor rendered again if their dependencies did not change since.
+        pages = read_build_index()
+        self.album.generate(dest_dir)
+        self.assertEqual(read_build_index(), pages)
+
+        # Pages which contents changed are written.
+        self.add_img(self.source_dir, "img02.jpg")
+        self.album.generate(dest_dir)
+        self.assertNotEqual(os.stat(page_paths[0]).st_ino, page_stats[0].st_ino)
+        self.assertNotEqual(read_build_index()["index.html"], pages["index.html"])
+
+    def test_profile_build(self):
+        profile_path = os.path.join(self.tmpdir, "profile.json")
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "profile-build", profile_path)
+        self.setup_album(config)
+
+        self.setup_subgal("subgal", ["img01.jpg", "img02.jpg"])
         dest_dir = self.get_working_path()
         self.album.generate(dest_dir)
 
-        self.assertTrue(os.path.isfile(os.path.join(dest_dir, "src.zip")))
+        with open(profile_path) as profile_fp:
+            report = json.load(profile_fp)
+        self.assertEqual(
+            sorted(report["phases"].keys()), ["build", "needs_build", "populate_deps"]
+        )
+        self.assertEqual(report["classes"]["WebalbumBrowsePage"]["build"]["count"], 4)
+        self.assertGreater(report["classes"]["ImageOtherSize"]["build"]["wall"], 0)
+        self.assertIn(os.path.join(dest_dir, "subgal"), report["dirs"])
+        slowest = report["slowest"]
+        self.assertEqual(slowest, sorted(slowest, key=lambda r: -r["wall"]))
+
+        profile_path = os.path.join(self.tmpdir, "profile.csv")
+        self.album.config.set("runtime", "profile-build", profile_path)
+        self.album.generate(dest_dir)
+        with open(profile_path) as profile_fp:
+            self.assertTrue(profile_fp.readline().startswith("task,class,dir,phase"))
 
     def test_filter_by_tag(self):
         config = lazygal.config.LazygalConfig()
@@ -770,6 +933,35 @@ class TestGenerators(LazygalTestGen):
                 os.path.isfile(os.path.join(dest_subgal_path, fn)), error % fn
             )
 
+    def test_video_thumbnail_frame(self):
+        frames_dir = self.get_working_path()
+
+        def frame(name, colors):
+            im = Image.new("RGB", (len(colors), 1))
+            im.putdata([(c, c, c) for c in colors])
+            path = os.path.join(frames_dir, name)
+            im.save(path, "PNG")
+            return path
+
+        # mse is closest to the average histogram for two out of three frames
+        frames = [
+            frame("gray.png", [128, 128]),
+            frame("contrast.png", [0, 255]),
+            frame("contrast2.png", [0, 255]),
+        ]
+        thumbnailer = VideoThumbnailer("vid.mov")
+        self.assertEqual(thumbnailer.find_most_representative(frames), frames[1])
+
+        # colour distance matters with the perceptual metric
+        frames = [
+            frame("black.png", [0]),
+            frame("gray128.png", [128]),
+            frame("gray140.png", [140]),
+        ]
+        self.assertEqual(thumbnailer.find_most_representative(frames), frames[0])
+        thumbnailer = VideoThumbnailer("vid.mov", metric="perceptual")
+        self.assertEqual(thumbnailer.find_most_representative(frames), frames[1])
+
     def test_brokenpics(self):
         # create zero-size img in source_dir
         self.create_file(os.path.join(self.source_dir, "img.jpg"))
@@ -822,6 +1014,180 @@ class TestSpecialGens(LazygalTestGen):
         # FIXME: Check dest dir contents, test only catches uncaught exceptions
         # for now...
 
+    def test_streaming(self):
+        """
+        Streaming generation shall produce the same galleries, except for
+        the pictures picked for the album pictures.
+        """
+        self.setup_album()
+        self.add_img(self.source_dir, "img.jpg")
+        self.setup_subgal("sub1", ["sub1_img.jpg", "sub1_img2.jpg"])
+        self.setup_subgal(os.path.join("sub1", "subsub"), ["subsub_img.jpg"])
+        self.setup_subgal("sub2", ["sub2_img.jpg"])
+
+        def read_gallery(dest_path):
+            gallery = {}
+            for root, dirnames, filenames in os.walk(dest_path):
+                for fn in filenames:
+                    path = os.path.join(root, fn)
+                    if fn.endswith(".html") or fn == "index.json":
+                        with open(path) as fp:
+                            contents = [l for l in fp if "Generated by" not in l]
+                    else:
+                        contents = None
+                    gallery[os.path.relpath(path, dest_path)] = contents
+            return gallery
+
+        self.album.generate(self.dest_path)
+
+        streamed_path = os.path.join(self.tmpdir, "streamed")
+        self.album.config.set("runtime", "streaming", True)
+        self.album.generate(streamed_path)
+        self.assertEqual(read_gallery(streamed_path), read_gallery(self.dest_path))
+
+        index_path = os.path.join(streamed_path, "index.html")
+        index_mtime = os.path.getmtime(index_path)
+        self.album.generate(streamed_path)
+        self.assertEqual(os.path.getmtime(index_path), index_mtime)
+
+    def test_parallel_jobs(self):
+        """
+        Building with several jobs shall produce the same files as a serial
+        build, and leave nothing to rebuild.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "jobs", 4)
+        self.setup_album(config)
+
+        pics = ["img%d.jpg" % i for i in range(0, 6)]
+        source_subgal = self.setup_subgal("subgal", pics)
+
+        self.album.generate(self.dest_path)
+
+        dest_subgal_path = os.path.join(self.dest_path, "subgal")
+        for pic in pics:
+            name, ext = os.path.splitext(pic)
+            for fn in (
+                name + ".html",
+                name + "_medium.html",
+                name + "_thumb.jpg",
+                name + "_small.jpg",
+                name + "_medium.jpg",
+            ):
+                self.assertTrue(os.path.isfile(os.path.join(dest_subgal_path, fn)))
+
+        webgal = WebalbumDir(source_subgal, [], self.album, self.dest_path)
+        self.assertFalse(webgal.needs_build())
+
+    def test_parallel_resizes(self):
+        """
+        With several jobs, the pictures of a directory shall be resized at the
+        same time, not one media after the other.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "jobs", 4)
+        self.setup_album(config)
+        self.setup_subgal("subgal", ["img%d.jpg" % i for i in range(0, 6)])
+
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+        batch_build = genmedia.ImageResizeBatch.build
+
+        def build(batch):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            try:
+                time.sleep(0.1)
+                batch_build(batch)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        genmedia.ImageResizeBatch.build = build
+        try:
+            self.album.generate(self.dest_path)
+        finally:
+            genmedia.ImageResizeBatch.build = batch_build
+
+        self.assertGreater(most_running[0], 1)
+
+    def test_metadata_cache_closed(self):
+        """
+        The metadata cache is closed along with the album.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "metadata-cache", os.path.join(self.tmpdir, "md.db"))
+        self.setup_album(config)
+        self.setup_subgal("subgal", ["img.jpg"])
+
+        with self.album as album:
+            album.generate(self.dest_path)
+            db = album.mdcache.db
+        self.assertIsNone(self.album.mdcache)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            db.execute("SELECT * FROM media")
+
+    @unittest.skipIf(not HAVE_VIDEO, "video support not available")
+    def test_parallel_video_jobs(self):
+        """
+        Videos transcoded in the background shall all be done once the
+        generation returns.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("runtime", "video-jobs", 2)
+        self.setup_album(config)
+
+        self.setup_subgal("subgal", ["img.jpg"], ["vid.mov", "vid2.mov"])
+
+        self.album.generate(self.dest_path)
+
+        dest_subgal_path = os.path.join(self.dest_path, "subgal")
+        for fn in (
+            "img_thumb.jpg",
+            "vid.html",
+            "vid_thumb.jpg",
+            "vid_video.webm",
+            "vid2.html",
+            "vid2_video.webm",
+        ):
+            self.assertTrue(os.path.isfile(os.path.join(dest_subgal_path, fn)))
+
+    @unittest.skipIf(not HAVE_VIDEO, "video support not available")
+    def test_video_batch_serial_only(self):
+        """
+        The thumbnail and the transcoding of a video shall share a single
+        decoding in serial builds only, so that thumbnails do not wait for
+        the background transcodings.
+        """
+        batches = []
+        batch_build = genmedia.VideoBatch.build
+
+        def build(batch):
+            batches.append(batch)
+            batch_build(batch)
+
+        genmedia.VideoBatch.build = build
+        try:
+            self.setup_album()
+            self.setup_subgal("subgal", [], ["vid.mov"])
+            self.album.generate(self.dest_path)
+            self.assertEqual(len(batches), 1)
+
+            config = lazygal.config.LazygalConfig()
+            config.set("runtime", "video-jobs", 2)
+            self.setup_album(config)
+            parallel_dest_path = self.get_working_path()
+            self.album.generate(parallel_dest_path)
+            self.assertEqual(len(batches), 1)
+        finally:
+            genmedia.VideoBatch.build = batch_build
+
+        dest_subgal_path = os.path.join(parallel_dest_path, "subgal")
+        for fn in ("vid_thumb.jpg", "vid_video.webm"):
+            self.assertTrue(os.path.isfile(os.path.join(dest_subgal_path, fn)))
+
     @unittest.skipIf(not has_symlinks(), "symlinks not supported on platform")
     def test_dir_symlink(self):
         """
@@ -1094,6 +1460,51 @@ class TestSorting(LazygalTestGen):
             ["john", "joe", "albert", "2012_Trip", "1999_Christmas"],
         )
 
+    def test_latest_stamps_aggregate(self):
+        """
+        The latest media stamps of a directory tree are aggregated in the
+        indexes from the subdirectories ones.
+        """
+        config = lazygal.config.LazygalConfig()
+        config.set("webgal", "sort-subgals", "exif")
+        self.setup_album(config)
+
+        pic_stamps = {
+            "a": datetime.datetime(2011, 1, 1).timestamp(),
+            "b": datetime.datetime(2010, 1, 1).timestamp(),
+            os.path.join("b", "deep"): datetime.datetime(2012, 1, 1).timestamp(),
+        }
+        for subgal_name, stamp in pic_stamps.items():
+            subgal_path = os.path.join(self.source_dir, subgal_name)
+            os.makedirs(subgal_path)
+            img_path = self.add_img(subgal_path, "pic.jpg")
+            os.utime(img_path, (stamp, stamp))
+
+        self.album.generate(self.dest_path)
+
+        def read_latest(subgal_name):
+            path = os.path.join(self.dest_path, subgal_name, "index.json")
+            with open(path) as index_fp:
+                return json.load(index_fp)["latest"]
+
+        self.assertEqual(
+            read_latest("b")["mtime"], pic_stamps[os.path.join("b", "deep")]
+        )
+        self.assertEqual(read_latest("a")["mtime"], pic_stamps["a"])
+
+        deep = Directory(
+            os.path.join(self.source_dir, "b", "deep"), [], ["pic.jpg"], self.album
+        )
+        b = Directory(
+            os.path.join(self.source_dir, "b"), [deep], ["pic.jpg"], self.album
+        )
+        a = Directory(os.path.join(self.source_dir, "a"), [], ["pic.jpg"], self.album)
+        root = Directory(self.source_dir, [a, b], [], self.album)
+        self.assertEqual(
+            read_latest(""),
+            dict(zip(("date", "mtime"), root.latest_media_stamps(from_media=True))),
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -23,6 +23,7 @@ import os
 import posixpath
 import ntpath
 from . import LazygalTest
+from lazygal import pathutils
 from lazygal.pathutils import *
 from lazygal.sourcetree import Directory
 
@@ -92,6 +93,57 @@ class TestPathutils(LazygalTest):
         self.assertEqual(url_quote("filter: user/"), "filter%3A%20user/")
         self.assertEqual(url_quote("index.html", "id"), "index.html#id")
 
+    def test_scan_journal(self):
+        self.f("/album/a.jpg")
+        self.f("/album/sub/b.jpg")
+        self.f("/album/sub/deeper/c.jpg")
+        self.f("/elsewhere/e.jpg")
+        os.symlink(self.d("/elsewhere"), os.path.join(self.d("/album"), "link"))
+
+        top = self.d("/album")
+        past = 100000
+        for dpath in ("/album", "/album/sub", "/album/sub/deeper"):
+            os.utime(self.d(dpath), (past, past))
+
+        def listing(walk):
+            return sorted((r, sorted(d), sorted(f)) for r, d, f in walk)
+
+        journal = ScanJournal()
+        self.assertEqual(listing(journal.walk(top)), listing(walk(top)))
+        self.assertEqual(len(journal.updated), 3)
+        self.assertIn(os.path.join(top, "link"), [r for r, d, f in journal.walk(top)])
+
+        # Unchanged directories are not listed again.
+        journal = ScanJournal(journal.entries)
+        self.assertEqual(listing(journal.walk(top)), listing(walk(top)))
+        self.assertEqual(journal.updated, {})
+
+        self.f("/album/sub/d.jpg")
+        os.utime(self.d("/album/sub"), (past + 1, past + 1))
+        journal.updated = {}
+        self.assertEqual(listing(journal.walk(top)), listing(walk(top)))
+        self.assertEqual(list(journal.updated.keys()), [self.d("/album/sub")])
+
+    @unittest.skipIf(not hasattr(os, "copy_file_range"), "no copy_file_range")
+    def test_copy_file_short(self):
+        src = self.f("/src.jpg")
+        with open(src, "wb") as src_fp:
+            src_fp.write(b"\0" * 4096)
+        dst = os.path.join(self.d("/dst"), "dst.jpg")
+
+        # The in-kernel copy gives up before the end of the source.
+        copy_file_range = os.copy_file_range
+        os.copy_file_range = lambda src_fd, dst_fd, count: 0
+        fcntl = pathutils.fcntl
+        pathutils.fcntl = None  # no reflinks
+        try:
+            self.assertRaises(OSError, clone_file, src, dst)
+            copy_file(src, dst)
+        finally:
+            os.copy_file_range = copy_file_range
+            pathutils.fcntl = fcntl
+        self.assertEqual(os.path.getsize(dst), 4096)
+
 
 if __name__ == "__main__":
     unittest.main()
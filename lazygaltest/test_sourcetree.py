@@ -25,8 +25,10 @@ from gi.repository import GExiv2
 
 
 from . import LazygalTest
+from lazygal import make
+from lazygal.mdcache import MetadataCache
 from lazygal.generators import Album
-from lazygal.sourcetree import Directory
+from lazygal.sourcetree import Directory, DirectorySummary
 
 
 class TestSourceTree(LazygalTest):
@@ -66,6 +68,60 @@ class TestSourceTree(LazygalTest):
         ]
         self.assertEqual(d.parent_paths(), expected)
 
+    def test_tree_traversal(self):
+        def make_dir(drpath, pics, subdirs=()):
+            dpath = os.path.join(self.source_dir, drpath)
+            os.makedirs(dpath, exist_ok=True)
+            for pic in pics:
+                self.add_img(dpath, pic)
+            return Directory(dpath, list(subdirs), pics, self.album)
+
+        deep = make_dir("a/deep", ["d.jpg"])
+        a = make_dir("a", ["a1.jpg", "a2.jpg"], [deep])
+        b = make_dir("b", [])
+        root = make_dir("", ["r.jpg"], [a, b])
+
+        self.assertEqual(list(root.iter_all_subdirs()), [a, b, deep])
+        self.assertEqual(root.get_all_subdirs(), [a, b, deep])
+        self.assertEqual(
+            [m.filename for m in root.iter_all_medias()],
+            ["r.jpg", "a1.jpg", "a2.jpg", "d.jpg"],
+        )
+        self.assertEqual(
+            next(root.iter_all_medias_paths()), os.path.join(self.source_dir, "r.jpg")
+        )
+        self.assertEqual(root.get_all_medias_count(), 4)
+        self.assertEqual(root.get_all_medias_count("image"), 4)
+        self.assertEqual(root.get_all_medias_count("video"), 0)
+        self.assertEqual(b.get_all_medias_count(), 0)
+
+    def test_summary_mtime(self):
+        """
+        The summary of a directory is as recent as the latest media below
+        it, even if that media is not in its sample.
+        """
+        deep_path = os.path.join(self.source_dir, "a", "deep")
+        os.makedirs(deep_path)
+        pics = ["d%d.jpg" % i for i in range(DirectorySummary.SAMPLE_SIZE + 2)]
+        for pic in pics:
+            self.add_img(deep_path, pic)
+        a_path = os.path.dirname(deep_path)
+        self.add_img(a_path, "a.jpg")
+
+        future = os.path.getmtime(deep_path) + 3600
+        os.utime(os.path.join(deep_path, "d3.jpg"), (future, future))
+
+        deep = DirectorySummary(
+            Directory(deep_path, [], pics, self.album), (None, None)
+        )
+        self.assertEqual(deep.get_mtime(), future)
+        self.assertLess(len(list(deep.iter_all_medias())), len(pics))
+
+        a = DirectorySummary(
+            Directory(a_path, [deep], ["a.jpg"], self.album), (None, None)
+        )
+        self.assertEqual(a.get_mtime(), future)
+
     def test_latest_media_stamp(self):
         dpath = os.path.join(self.source_dir, "srcdir")
         os.makedirs(dpath)
@@ -129,6 +185,60 @@ class TestSourceTree(LazygalTest):
             d.latest_media_stamp(from_media=True), datetime(2015, 8, 20).timestamp()
         )
 
+    def test_extract_medias_metadata(self):
+        dpath = os.path.join(self.source_dir, "srcdir")
+        os.makedirs(dpath)
+
+        pics = ["pic1.jpg", "pic2.jpg", "pic3.jpg", "pic4.jpg"]
+        for fn in pics:
+            self.add_img(dpath, fn)
+
+        serial_dir = Directory(dpath, [], pics, self.album)
+        for m in serial_dir.medias:
+            m.load_metadata(None)
+
+        d = Directory(dpath, [], pics, self.album)
+        with make.Scheduler(3):
+            d.extract_medias_metadata(None)
+        for m, serial_m in zip(d.medias, serial_dir.medias):
+            self.assertFalse(m.needs_metadata_extraction(None))
+            m.load_metadata(None)
+            self.assertEqual(m.md, serial_m.md)
+
+    def test_metadata_cache(self):
+        dpath = os.path.join(self.source_dir, "srcdir")
+        os.makedirs(dpath)
+
+        pics = ["pic1.jpg", "pic2.jpg"]
+        for fn in pics:
+            self.add_img(dpath, fn)
+
+        self.album.mdcache = MetadataCache(
+            os.path.join(self.get_working_path(), "md.db")
+        )
+
+        d = Directory(dpath, [], pics, self.album)
+        d.extract_medias_metadata(None)
+        cached = self.album.mdcache.load_dir(dpath)
+        self.assertEqual(sorted(cached.keys()), pics)
+
+        d2 = Directory(dpath, [], pics, self.album)
+        for m, m2 in zip(d.medias, d2.medias):
+            self.assertEqual(self.album.mdcache.lookup(cached, m2), m.md)
+
+        # A modified media file is not found in the cache anymore.
+        with open(os.path.join(dpath, "pic1.jpg"), "ab") as f:
+            f.write(b"\0")
+        self.assertIsNone(self.album.mdcache.lookup(cached, d2.medias[0]))
+
+        # Removed medias are forgotten.
+        os.unlink(os.path.join(dpath, "pic1.jpg"))
+        d3 = Directory(dpath, [], ["pic2.jpg"], self.album)
+        d3.extract_medias_metadata(None)
+        self.assertEqual(list(self.album.mdcache.load_dir(dpath)), ["pic2.jpg"])
+
+        self.album.mdcache.close()
+
 
 if __name__ == "__main__":
     unittest.main()
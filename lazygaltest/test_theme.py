@@ -20,6 +20,7 @@ import unittest
 import os
 from . import LazygalTest
 import lazygal.theme as t
+import lazygal.tpl
 
 
 class TestTheme(LazygalTest):
@@ -81,6 +82,81 @@ class TestTheme(LazygalTest):
             [(jslib, "lib.js"), (jslib, "js/lib-2.1.js"), (prefixed, "prefixed.txt")],
         )
 
+    def test_template_registry(self):
+        """
+        Templates and their includes are loaded once, and shared.
+        """
+        xi = 'xmlns:xi="http://www.w3.org/2001/XInclude"'
+        for name, include in (
+            ("page.thtml", "header.thtml"),
+            ("header.thtml", "title.thtml"),
+        ):
+            self.create_file(
+                os.path.join(self.theme_dir, name),
+                '<div %s><xi:include href="%s" /></div>' % (xi, include),
+            )
+        self.create_file(os.path.join(self.theme_dir, "title.thtml"), "<h1 />")
+
+        tpl_loader = lazygal.tpl.TplFactory(self.theme_dir, self.theme_dir)
+        page_tpl = tpl_loader.load("page.thtml")
+        self.assertIs(tpl_loader.load("page.thtml"), page_tpl)
+
+        deps = page_tpl.dependencies()
+        self.assertEqual(
+            [dep._path for dep in deps],
+            [
+                os.path.join(self.theme_dir, name)
+                for name in ("page.thtml", "header.thtml", "title.thtml")
+            ],
+        )
+        self.assertIs(page_tpl.dependencies(), deps)
+        self.assertIs(tpl_loader.load("header.thtml").dependencies()[0], deps[1])
+
+        tpl_loader.clear()
+        self.assertIsNot(tpl_loader.load("page.thtml"), page_tpl)
+
+    def test_compiled_render(self):
+        """
+        Compiled rendering gives the same bytes as Genshi, also when tags
+        are reused.
+        """
+        self.create_file(
+            os.path.join(self.theme_dir, "page.thtml"),
+            """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
+ "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:py="http://genshi.edgewall.org/"
+      xmlns:svg="http://www.w3.org/2000/svg" xml:lang="fr">
+  <head><title>${title}</title><!-- ${title} --></head>
+  <body>
+    <p py:for="i in items" class="item" py:attrs="{'id': 'i%d' % i}">
+      ${i} &amp; ${title}   \n\n\n
+    </p>
+    <pre>  ${title}
+
+  </pre>
+    <input type="checkbox" checked="${checked}" />
+    <div></div><br />
+    <svg:svg><svg:rect width="1" /></svg:svg>
+    <foo xmlns="urn:foo"><bar /></foo>
+    <script>/*<![CDATA[*/ 1 < 2 /*]]>*/</script>
+  </body>
+</html>""",
+        )
+        tpl_loader = lazygal.tpl.TplFactory(self.theme_dir, self.theme_dir)
+        page_tpl = tpl_loader.load("page.thtml")
+        renderer = lazygal.tpl.CompiledXHTMLRenderer()
+        for values in (
+            {"title": "A < B", "items": [1, 2], "checked": True},
+            {"title": "\u00e9t\u00e9", "items": [3], "checked": None},
+            {"title": "A < B", "items": [1, 2], "checked": True},
+        ):
+            expected = page_tpl.genshi_tpl.generate(**values).render(
+                method="xhtml", encoding="utf-8"
+            )
+            self.assertEqual(
+                renderer.render(page_tpl.genshi_tpl.generate(**values)), expected
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,64 @@
+# Lazygal, a lazy static web gallery generator.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import unittest
+
+from . import LazygalTestGen
+from lazygal import watch
+
+
+class TestWatch(LazygalTestGen):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.watcher = watch.InotifyWatcher(self.album)
+        except (OSError, AttributeError) as e:
+            self.skipTest("inotify not available: %s" % e)
+
+    def tearDown(self):
+        self.watcher.close()
+        super().tearDown()
+
+    def test_queue_overflow(self):
+        """
+        When the event queue overflowed, the whole album shall be checked,
+        and the directories created meanwhile shall be watched.
+        """
+        new_dir = os.path.join(self.source_dir, "new")
+        os.mkdir(new_dir)
+
+        read_events = self.watcher.read_events
+
+        def overflow():
+            # The creation event is lost in the overflow.
+            list(read_events())
+            self.watcher.read_events = read_events
+            yield -1, watch.InotifyWatcher.IN_Q_OVERFLOW, ""
+
+        self.watcher.read_events = overflow
+        self.assertEqual(self.watcher.wait(), {self.source_dir})
+        self.assertIn(new_dir, self.watcher.watched.values())
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# vim: ts=4 sw=4 expandtab